@@ -6,12 +6,193 @@ This module provides a CLI for processing PDF invoices from attachment IDs.
 
 import os
 import sys
+import mmap
+import fcntl
 import argparse
 import tempfile
-from pathlib import Path
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Iterator, List, Optional
 
-from invoice_extraction.core.processor import InvoiceSplitter
-from invoice_extraction.utils.logger import setup_logger
+import orjson
+
+from invoice_extraction.utils.cache import DiskCache, url_cache_key
+from invoice_extraction.utils.tempfiles import spooled_pdf_file
+
+# Cached attachment metadata is refetched after this many seconds
+METADATA_CACHE_TTL = 600
+
+# Per-attachment lock files live here so overlapping runs serialize on the same ID
+LOCK_DIR = tempfile.gettempdir()
+
+# Environment variables the splitter cannot run without
+REQUIRED_ENV_VARS = ("OPENAI_API_KEY", "API_URL", "S3_BUCKET_NAME")
+
+
+def ensure_env():
+    """Load .env only when a required variable is not already set in the environment."""
+    if all(os.getenv(name) for name in REQUIRED_ENV_VARS):
+        return
+    from dotenv import load_dotenv
+    load_dotenv(override=False)
+
+
+def require_env(logger: Any, *names: str):
+    """Exit with status 2 if any of the given environment variables is unset."""
+    missing = [name for name in names if not os.getenv(name)]
+    if missing:
+        logger.error(f"Missing required environment variable(s): {', '.join(missing)}")
+        raise SystemExit(2)
+
+
+def process_attachment(splitter: Any, attachment_id: int, output_dir: str,
+                       cache: Optional[DiskCache], logger: Any) -> List[str]:
+    """
+    Fetch, download and process a single attachment.
+    
+    Args:
+        splitter: InvoiceSplitter instance (shared across attachments)
+        attachment_id: Attachment ID to process
+        output_dir: Output directory for split invoices
+        cache: DiskCache for metadata and PDFs, or None to bypass caching
+        logger: Logger instance
+    
+    Returns:
+        List of output file paths (empty if no invoices were extracted)
+    """
+    # Hold an exclusive lock for the attachment so a second process started for
+    # the same ID (e.g. an overlapping retry) waits, then reuses this run's outputs
+    lock_path = os.path.join(LOCK_DIR, f"invoice-extract-{attachment_id}.lock")
+    with open(lock_path, "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            return process_attachment_locked(splitter, attachment_id, output_dir, cache, logger)
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def result_sentinel_path(output_dir: str, attachment_id: int) -> str:
+    """Return the path of the result sentinel for an attachment."""
+    return os.path.join(output_dir, f"attachment_{attachment_id}.result.json")
+
+
+def read_result_sentinel(output_dir: str, attachment_id: int, pdf_key: str) -> Optional[List[str]]:
+    """
+    Return output files recorded by a previous run, if still valid.
+    
+    The sentinel is only trusted when it was written for the same source file
+    and every output file it lists still exists.
+    """
+    try:
+        with open(result_sentinel_path(output_dir, attachment_id), "rb") as f:
+            result = orjson.loads(f.read())
+    except (OSError, orjson.JSONDecodeError):
+        return None
+    
+    output_files = result.get("output_files") or []
+    if result.get("source_key") != pdf_key or not output_files:
+        return None
+    if not all(os.path.exists(path) for path in output_files):
+        return None
+    return output_files
+
+
+def write_result_sentinel(output_dir: str, attachment_id: int, pdf_key: str, output_files: List[str]):
+    """Record the output files of a finished attachment for later runs."""
+    path = result_sentinel_path(output_dir, attachment_id)
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    with open(tmp_path, "wb") as f:
+        f.write(orjson.dumps({"source_key": pdf_key, "output_files": output_files}, option=orjson.OPT_INDENT_2))
+    os.replace(tmp_path, path)
+
+
+def process_attachment_locked(splitter: Any, attachment_id: int, output_dir: str,
+                              cache: Optional[DiskCache], logger: Any) -> List[str]:
+    """Body of process_attachment, run while holding the attachment lock."""
+    # Fetch attachment metadata
+    attachment_data = cache.get_json("meta", str(attachment_id), max_age=METADATA_CACHE_TTL) if cache else None
+    if attachment_data is None:
+        logger.info(f"Fetching attachment metadata for ID: {attachment_id}")
+        attachment_data = splitter.fetch_attachment_metadata(attachment_id)
+        if cache:
+            cache.set_json("meta", str(attachment_id), attachment_data)
+    else:
+        logger.info(f"Using cached attachment metadata for ID: {attachment_id}")
+    
+    file_url = attachment_data.get("fileUrl")
+    filename = attachment_data.get("filename", f"attachment_{attachment_id}.pdf")
+    
+    if not file_url:
+        raise ValueError("File URL not found in attachment metadata")
+    
+    logger.info(f"Attachment: {filename}")
+    logger.info(f"File URL: {file_url}")
+    
+    pdf_key = url_cache_key(file_url)
+    
+    # Outputs from a previous run on the same source file can be reused as-is
+    previous_outputs = read_result_sentinel(output_dir, attachment_id, pdf_key) if cache else None
+    if previous_outputs:
+        logger.info(f"Reusing outputs from a previous run for attachment {attachment_id}")
+        return previous_outputs
+    
+    # Only a run whose invoices were all uploaded and recorded may be reused;
+    # otherwise the next run publishes them again
+    unpublished = []
+    output_files = download_and_process(splitter, attachment_id, file_url, filename, pdf_key,
+                                        output_dir, cache, logger, unpublished)
+    if output_files and not unpublished:
+        write_result_sentinel(output_dir, attachment_id, pdf_key, output_files)
+    elif unpublished:
+        logger.warning(f"Not recording outputs of attachment {attachment_id}: "
+                       f"{len(unpublished)} invoice(s) were not published")
+    return output_files
+
+
+def download_and_process(splitter: Any, attachment_id: int, file_url: str, filename: str,
+                         pdf_key: str, output_dir: str, cache: Optional[DiskCache], logger: Any,
+                         unpublished: Optional[List[str]] = None) -> List[str]:
+    """
+    Download (or reuse the cached copy of) an attachment's PDF and process it.
+    
+    Output files whose upload or invoice record failed are appended to unpublished.
+    """
+    cached_pdf = cache.blob_path("pdfs", pdf_key, ".pdf") if cache else None
+    
+    if cached_pdf and cached_pdf.exists():
+        # Process the cached copy through a read-only mapping, with no download;
+        # PyMuPDF still copies the mapped bytes into memory once when opening it
+        logger.info(f"\nUsing cached PDF: {cached_pdf}")
+        with open(cached_pdf, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as pdf_view:
+            logger.info(f"\nProcessing PDF...")
+            return splitter.process_pdf(pdf_view, attachment_id, output_dir, unpublished=unpublished)
+    
+    # Download PDF into a spooled buffer (spills to tmpfs only for large files)
+    with spooled_pdf_file() as pdf_file:
+        logger.info(f"\nDownloading PDF from S3...")
+        splitter.download_pdf_from_url(file_url, pdf_file)
+        
+        if cache:
+            cache.store_blob("pdfs", pdf_key, pdf_file, ".pdf", metadata={
+                "attachment_id": attachment_id,
+                "filename": filename,
+            })
+        
+        # Process the PDF
+        logger.info(f"\nProcessing PDF...")
+        return splitter.process_pdf(pdf_file, attachment_id, output_dir, unpublished=unpublished)
+
+
+def read_attachment_ids(stream: Any, logger: Any) -> Iterator[int]:
+    """Yield attachment IDs from a line-oriented stream, skipping blank or invalid lines."""
+    for line in stream:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield int(line)
+        except ValueError:
+            logger.error(f"Ignoring invalid attachment ID: {line!r}")
 
 
 def main():
@@ -23,6 +204,8 @@ def main():
 Examples:
   invoice-extract 6
   invoice-extract 6 --output-dir ./split_invoices
+  invoice-extract 6 7 8 9 --concurrency 4
+  seq 100 200 | invoice-extract --serve
   
 Environment Variables Required:
   OPENAI_API_KEY - OpenAI API key for GPT-4 Vision
@@ -32,74 +215,204 @@ Environment Variables Required:
         """
     )
     parser.add_argument(
-        "attachment_id",
+        "attachment_ids",
+        metavar="attachment_id",
         type=int,
-        help="Attachment ID to process"
+        nargs="*",
+        help="Attachment ID(s) to process"
     )
     parser.add_argument(
         "--output-dir",
         help="Output directory for split invoices (default: ./output)",
         default="output"
     )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=10,
+        help="Number of attachments processed in parallel (default: 10)"
+    )
+    parser.add_argument(
+        "--serve",
+        action="store_true",
+        help="Keep one splitter alive and process attachment IDs read from stdin (one per line) until EOF"
+    )
+    parser.add_argument(
+        "--vision-concurrency",
+        type=int,
+        default=None,
+        help="Vision API requests in flight per document (default: VISION_CONCURRENCY or 8)"
+    )
+    parser.add_argument(
+        "--extraction-batch",
+        type=int,
+        default=None,
+        help="Invoices extracted per Vision API request (default: EXTRACTION_BATCH_SIZE or 1)"
+    )
+    parser.add_argument(
+        "--boundary-batch",
+        type=int,
+        default=None,
+        help="Pages classified per boundary detection request, up to 20 (default: BOUNDARY_BATCH_SIZE or 1)"
+    )
+    parser.add_argument(
+        "--single-call-pages",
+        type=int,
+        default=None,
+        help="Split and extract documents of up to N pages (at most 20) in one Vision API request "
+             "(default: SINGLE_CALL_MAX_PAGES or 0, off)"
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Ignore and do not update the local metadata/PDF cache (~/.cache/invoice-extractor)"
+    )
+    parser.add_argument(
+        "--no-llm-cache",
+        action="store_true",
+        help="Always call the Vision API instead of replaying cached responses"
+    )
+    parser.add_argument(
+        "--llm-cache-dir",
+        help="Root directory for cached Vision API responses (default: ~/.cache/invoice-extractor)"
+    )
+    parser.add_argument(
+        "--profile",
+        metavar="PATH",
+        help="Profile the run with cProfile and write pstats data to PATH "
+             "(attachments and Vision calls then run one at a time on the main thread; status updates, "
+             "S3 uploads and invoice records run in background threads and are not captured)"
+    )
     
     args = parser.parse_args()
+    if args.serve and args.attachment_ids:
+        parser.error("attachment IDs are read from stdin with --serve")
+    if not args.serve and not args.attachment_ids:
+        parser.error("at least one attachment_id is required (or use --serve)")
+    if args.concurrency < 1:
+        parser.error("--concurrency must be at least 1")
+    if args.vision_concurrency is not None and args.vision_concurrency < 1:
+        parser.error("--vision-concurrency must be at least 1")
+    if args.extraction_batch is not None and args.extraction_batch < 1:
+        parser.error("--extraction-batch must be at least 1")
+    if args.boundary_batch is not None and args.boundary_batch < 1:
+        parser.error("--boundary-batch must be at least 1")
+    if args.single_call_pages is not None and args.single_call_pages < 0:
+        parser.error("--single-call-pages must not be negative")
+    
+    if args.profile:
+        # cProfile only sees the thread it was enabled on, so run attachments
+        # and Vision calls on the main thread while profiling (status updates
+        # and publishing stay on their background threads)
+        import cProfile
+        args.concurrency = 1
+        args.vision_concurrency = 1
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            run(args)
+        finally:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+            print(f"Profile written to {args.profile} (view with: python -m pstats {args.profile})",
+                  file=sys.stderr)
+    else:
+        run(args)
+
+
+def run(args: argparse.Namespace):
+    """Process the attachments selected by the parsed command-line arguments."""
+    from invoice_extraction.utils.logger import setup_logger
     
     # Set up logger
     logger = setup_logger("invoice-extraction")
     
-    temp_pdf_path = None
+    # Fail before any imports, client construction or network calls
+    require_env(logger, *REQUIRED_ENV_VARS)
+    
+    # Imported here so --help, argument errors and misconfigured runs don't pay
+    # for loading boto3, openai, pypdf and PIL
+    from invoice_extraction.core.processor import InvoiceSplitter
     
     try:
-        # Initialize the splitter
-        logger.info(f"Initializing invoice splitter for attachment ID: {args.attachment_id}")
-        splitter = InvoiceSplitter(logger=logger)
-        
-        # Fetch attachment metadata
-        logger.info(f"Fetching attachment metadata for ID: {args.attachment_id}")
-        attachment_data = splitter.fetch_attachment_metadata(args.attachment_id)
-        
-        file_url = attachment_data.get("fileUrl")
-        filename = attachment_data.get("filename", f"attachment_{args.attachment_id}.pdf")
-        
-        if not file_url:
-            raise ValueError("File URL not found in attachment metadata")
-        
-        logger.info(f"Attachment: {filename}")
-        logger.info(f"File URL: {file_url}")
-        
-        # Download PDF to temporary location
-        temp_pdf_path = tempfile.mktemp(suffix=".pdf", prefix=f"attachment_{args.attachment_id}_")
-        logger.info(f"\nDownloading PDF from S3...")
-        splitter.download_pdf_from_url(file_url, temp_pdf_path)
-        
-        # Process the PDF
-        logger.info(f"\nProcessing PDF...")
-        output_files = splitter.process_pdf(temp_pdf_path, args.attachment_id, args.output_dir)
-        
-        if output_files:
-            logger.info("\nOutput files:")
-            for file in output_files:
-                logger.info(f"  - {file}")
-            logger.info(f"\n✓ Successfully processed attachment {args.attachment_id}")
-            sys.exit(0)
+        # Initialize one splitter and share its HTTP/S3/OpenAI clients across attachments
+        if args.serve:
+            logger.info("Initializing invoice splitter in serve mode (reading attachment IDs from stdin)")
         else:
-            logger.error("\nNo invoices were extracted (file may be corrupted)")
-            sys.exit(1)
-            
+            logger.info(f"Initializing invoice splitter for attachment ID(s): {args.attachment_ids}")
+        llm_cache = None if args.no_llm_cache else DiskCache(args.llm_cache_dir)
+        splitter = InvoiceSplitter(logger=logger, vision_concurrency=args.vision_concurrency, llm_cache=llm_cache,
+                                   extraction_batch_size=args.extraction_batch,
+                                   boundary_batch_size=args.boundary_batch,
+                                   single_call_max_pages=args.single_call_pages)
     except Exception as e:
         logger.error(f"Error: {e}", exc_info=True)
         sys.exit(1)
-    finally:
-        # Clean up temporary PDF file
-        if temp_pdf_path and os.path.exists(temp_pdf_path):
+    
+    cache = None if args.no_cache else DiskCache()
+    submitted_ids = []
+    failed_ids = []
+    failed_lock = threading.Lock()
+    
+    def report(attachment_id: int, future: Future):
+        """Log the outcome of one attachment as soon as it finishes."""
+        try:
+            output_files = future.result()
+        except Exception as e:
+            logger.error(f"Error processing attachment {attachment_id}: {e}", exc_info=True)
+            output_files = None
+        
+        if output_files:
+            logger.info(f"\nOutput files for attachment {attachment_id}:")
+            for file in output_files:
+                logger.info(f"  - {file}")
+            logger.info(f"\n✓ Successfully processed attachment {attachment_id}")
+            return
+        
+        if output_files is not None:
+            logger.error(f"\nNo invoices were extracted for attachment {attachment_id} (file may be corrupted)")
+        with failed_lock:
+            failed_ids.append(attachment_id)
+    
+    if args.serve:
+        attachment_ids = read_attachment_ids(sys.stdin, logger)
+        max_workers = args.concurrency
+    else:
+        attachment_ids = args.attachment_ids
+        max_workers = min(args.concurrency, len(args.attachment_ids))
+    
+    if max_workers == 1:
+        # Process inline so profiling and debugging see the real call stack
+        for attachment_id in attachment_ids:
+            submitted_ids.append(attachment_id)
+            future = Future()
             try:
-                os.remove(temp_pdf_path)
-                logger.info(f"\nCleaned up temporary file: {temp_pdf_path}")
+                future.set_result(process_attachment(splitter, attachment_id, args.output_dir, cache, logger))
             except Exception as e:
-                logger.warning(f"\nWarning: Failed to clean up temporary file: {e}")
+                future.set_exception(e)
+            report(attachment_id, future)
+    else:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for attachment_id in attachment_ids:
+                submitted_ids.append(attachment_id)
+                future = executor.submit(process_attachment, splitter, attachment_id, args.output_dir, cache, logger)
+                future.add_done_callback(lambda f, aid=attachment_id: report(aid, f))
+    
+    if splitter.llm_cache:
+        stats = splitter.llm_cache_stats
+        logger.info(f"\nLLM cache: {stats['hits']} hit(s), {stats['misses']} miss(es)")
+    for detail, usage in splitter.token_usage.items():
+        if usage["calls"]:
+            logger.info(f"Vision tokens ({detail} detail): {usage['calls']} call(s), "
+                        f"{usage['prompt_tokens']} prompt ({usage['cached_tokens']} cached), "
+                        f"{usage['completion_tokens']} completion")
+    
+    if failed_ids:
+        logger.error(f"\n✗ {len(failed_ids)} of {len(submitted_ids)} attachment(s) failed: {sorted(failed_ids)}")
+        sys.exit(1)
+    sys.exit(0)
 
 
 if __name__ == "__main__":
-    from dotenv import load_dotenv
-    load_dotenv()
+    ensure_env()
     main()
@@ -6,22 +6,450 @@ including corruption detection, repair, invoice splitting, and data extraction.
 """
 
 import os
-import json
+import re
+import copy
 import base64
 import shutil
-import tempfile
+import hashlib
+import time
+import logging
+import threading
+import weakref
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from collections import OrderedDict
+from contextlib import nullcontext
 from pathlib import Path
 from io import BytesIO
-from typing import List, Dict, Optional, Tuple, Any
+from typing import List, Dict, Optional, Tuple, Any, BinaryIO, Union, Callable
+from urllib.parse import urlparse, unquote
 
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import boto3
-from botocore.exceptions import ClientError
+from boto3.s3.transfer import TransferConfig, create_transfer_manager
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
 from openai import OpenAI
-from pdf2image import convert_from_path
+import pymupdf
 from pypdf import PdfReader, PdfWriter
 from PIL import Image
 
+from invoice_extraction.utils.cache import DiskCache
+from invoice_extraction.utils.tempfiles import atomic_output_path
+
+
+# Multipart settings for S3 downloads: objects above the threshold are fetched
+# as concurrent ranged GETs and reassembled into the target file object
+S3_DOWNLOAD_CONFIG = TransferConfig(
+    multipart_threshold=5 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024,
+    max_concurrency=min(16, (os.cpu_count() or 1) * 2),
+    use_threads=True,
+)
+
+# Settings for the shared upload transfer manager: max_concurrency bounds the
+# PUT/part requests in flight across all uploads of the process (overridable
+# with S3_MAX_CONCURRENCY), and output files at or above 8 MB are sent as
+# parallel multipart uploads
+S3_UPLOAD_CONFIG = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024,
+    max_concurrency=16,
+    use_threads=True,
+)
+
+# Connection pool and retry settings for the shared S3 client; the pool is sized
+# for several attachments each running a multipart transfer at once
+S3_CLIENT_CONFIG = Config(
+    max_pool_connections=64,
+    retries={"max_attempts": 5, "mode": "adaptive"},
+    tcp_keepalive=True,
+    s3={"addressing_style": "virtual"},
+)
+
+_s3_client = None
+_s3_client_lock = threading.Lock()
+_s3_transfer = None
+
+# PyMuPDF is not thread-safe, and attachments are processed on several threads
+# sharing one splitter, so every MuPDF call (open, render, insert_pdf, save,
+# close) holds this lock; process_batch gives real rendering parallelism
+_mupdf_lock = threading.RLock()
+
+# Keep-alive pool and retry policy for the attachment API and HTTP downloads.
+# Only idempotent methods are retried here; invoice POSTs are resent only on
+# statuses that guarantee no record was created (RECORD_POST_RETRY_STATUSES).
+HTTP_POOL_CONNECTIONS = 20
+HTTP_POOL_MAXSIZE = 50
+HTTP_RETRY = Retry(total=3, status_forcelist=[502, 503, 504], backoff_factor=0.3)
+
+# Request headers for bodies pre-serialized with orjson
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+# Invoice record POSTs are retried with exponential backoff only on statuses that
+# mean the request was rejected unprocessed; after a 500, 502 or 504 the record may
+# already have been created, so those are not retried. A server's Retry-After is
+# honoured up to RECORD_POST_MAX_RETRY_DELAY seconds
+RECORD_POST_ATTEMPTS = 3
+RECORD_POST_RETRY_STATUSES = (429, 503)
+RECORD_POST_MAX_RETRY_DELAY = 30
+
+# Attachment metadata is reused in-process for this many seconds (most recent
+# entries only), so retried or redelivered attachments skip the API round trip
+ATTACHMENT_METADATA_TTL = 600
+ATTACHMENT_METADATA_CACHE_SIZE = 1024
+
+# Characters dropped from invoice numbers used in output file names (anything
+# but letters, digits, "_" and "-")
+INVOICE_FILENAME_UNSAFE_CHARS = re.compile(r"[^\w-]+")
+
+# Invoice fields filled from a later page group when the earlier one left them empty
+INVOICE_SCALAR_FIELDS = (
+    "customer_name", "vendor_name", "vendor_address", "vendor_phone", "vendor_email", "invoice_date", "due_date",
+    "total_amount", "currency", "total_tax", "description", "invoice_number",
+)
+
+# Logging levels for the level names accepted by InvoiceSplitter._log
+LOG_LEVELS = {"error": logging.ERROR, "warning": logging.WARNING, "info": logging.INFO, "debug": logging.DEBUG}
+
+# Maximum invoices of one document being uploaded and recorded at once
+PUBLISH_MAX_WORKERS = 8
+
+# Default cap on worker processes for InvoiceSplitter.process_batch
+BATCH_MAX_WORKERS = 8
+
+# OpenAI model used for page analysis and data extraction
+VISION_MODEL = "gpt-4o"
+
+# Reply budget per invoice for data extraction, the model's output ceiling for a
+# batched extraction call, and the most page images sent in one request
+EXTRACTION_MAX_TOKENS = 2000
+EXTRACTION_BATCH_MAX_TOKENS = 16000
+MAX_IMAGES_PER_REQUEST = 20
+
+# Recent Vision replies kept in memory per splitter, keyed by request hash
+LLM_MEMORY_CACHE_SIZE = 256
+
+# Reply budget for boundary detection: one page alone, and each page of a
+# multi-page boundary request
+BOUNDARY_MAX_TOKENS = 200
+BOUNDARY_TOKENS_PER_PAGE = 150
+
+# Image sizes sent to the Vision API, matching what the model actually sees:
+# low detail images are reduced to 512px, and high detail images to fit 2048px
+# with the short edge at most 768px, so larger uploads only add bytes. Pages are
+# rendered straight to the extraction size
+ANALYSIS_MAX_EDGE = 512
+EXTRACTION_MAX_EDGE = 2048
+EXTRACTION_MAX_SHORT_EDGE = 768
+
+# Small pages (receipts, half-letter) are not rendered above this resolution
+# just to fill the extraction size; it adds pixels but no legible detail
+RENDER_MAX_DPI = 150
+
+# JPEG quality of rendered pages, matching image_to_jpeg's default so MuPDF's
+# JPEG output is sent for extraction as-is instead of being re-encoded
+RENDER_JPEG_QUALITY = 85
+
+# Page images can be handed to the Vision API as short-lived presigned S3 URLs
+# instead of inline base64 (VISION_IMAGE_URLS=1); objects under this prefix are
+# content-addressed and should be expired by a bucket lifecycle rule
+VISION_IMAGE_PREFIX = "tmp/vision/"
+VISION_IMAGE_URL_EXPIRY = 600
+
+# Range size and parallelism for plain HTTP downloads (e.g. presigned URLs)
+HTTP_RANGE_CHUNK_SIZE = 8 * 1024 * 1024
+HTTP_RANGE_MAX_WORKERS = 8
+
+# (connect, read) timeouts for file downloads and the socket read size used to fill buffers
+HTTP_DOWNLOAD_TIMEOUT = (5, 60)
+HTTP_READ_CHUNK_SIZE = 1024 * 1024
+
+# Prompts are fixed text, with any per-request details (page numbers, counts)
+# appended at the end, so identical prefixes can be served from OpenAI's prompt cache
+
+# What to look for when classifying a page (shared by per-page and multi-page requests)
+PAGE_BOUNDARY_QUESTIONS = """1. Does this page START a new invoice? (Look for invoice headers, invoice numbers, "INVOICE" title, billing/shipping addresses at top)
+2. Is this page a CONTINUATION of a previous invoice? (Look for "continued from previous page", partial tables, no invoice header)
+3. What is the invoice number/identifier if visible? (e.g., "INV-12345", "Invoice #67890")
+
+Consider these patterns:
+- New invoice pages typically have: Invoice header/title, invoice number prominently displayed, billing "From" and "To" addresses, invoice date
+- Continuation pages typically have: Itemized lists continuing, page numbers like "Page 2 of 3", no invoice header/number, table rows continuing
+- Some invoices may have multiple invoices on one page (rare but possible)"""
+
+# Boundary detection for a single page
+PAGE_ANALYSIS_PROMPT = f"""Analyze this document page and determine:
+
+{PAGE_BOUNDARY_QUESTIONS}
+
+Respond ONLY with valid JSON in this exact format:
+{{
+    "is_invoice_start": true/false,
+    "is_continuation": true/false,
+    "invoice_number": "string or null",
+    "confidence": 0.0-1.0,
+    "reasoning": "brief explanation"
+}}"""
+
+# Boundary detection for a run of consecutive pages in one request
+DOCUMENT_BOUNDARY_PROMPT = f"""The attached images are consecutive pages of one document, in order. For EACH page determine:
+
+{PAGE_BOUNDARY_QUESTIONS}
+
+Respond ONLY with valid JSON in this exact format, with one entry per image in page order:
+{{
+    "pages": [
+        {{
+            "page": 1,
+            "is_invoice_start": true/false,
+            "is_continuation": true/false,
+            "invoice_number": "string or null",
+            "confidence": 0.0-1.0,
+            "reasoning": "brief explanation"
+        }}
+    ]
+}}"""
+
+# Data extraction instructions for one invoice (also the prefix of batched requests)
+INVOICE_EXTRACTION_PROMPT = """Analyze this invoice document and extract all relevant information.
+
+For multi-page invoices, combine information from all pages.
+
+Extract and return the following information in JSON format:
+
+1. invoice_number: The invoice number/identifier
+2. customer_name: The customer/buyer name (the "Bill To" or recipient)
+3. vendor_name: The vendor/seller name (the "From" or issuer)
+4. vendor_address: The vendor/seller address (the "From" or issuer address)
+5. vendor_phone: The vendor/seller phone number (the "From" or issuer phone number)
+6. vendor_email: The vendor/seller email address (the "From" or issuer email address)
+7. invoice_date: Invoice date in YYYY-MM-DD format
+8. due_date: Payment due date in YYYY-MM-DD format (if available)
+9. total_amount: Total invoice amount as a number
+10. currency: Currency code (USD, EUR, etc.)
+11. total_tax: Total tax amount as a number
+12. description: Brief description or summary of the invoice
+13. line_items: Array of items with:
+   - item_name: Name/description of the item/service
+   - quantity: Quantity ordered
+   - unit_price: Price per unit (null if not available)
+   - total_price: Total price for this line item
+
+Important:
+- If a field is not found, use null
+- For line_items, extract ALL items across all pages
+- Ensure amounts are numbers, not strings
+- Use YYYY-MM-DD format for dates
+
+Respond ONLY with valid JSON in this exact format:
+{
+    "invoice_number": "string or null",
+    "customer_name": "string or null",
+    "vendor_name": "string or null",
+    "vendor_address": "string or null",
+    "vendor_phone": "string or null",
+    "vendor_email": "string or null",
+    "invoice_date": "YYYY-MM-DD or null",
+    "due_date": "YYYY-MM-DD or null",
+    "total_amount": number or null,
+    "currency": "string or null",
+    "total_tax": number or null,
+    "description": "string or null",
+    "line_items": [
+        {
+            "item_name": "string",
+            "quantity": number or null,
+            "unit_price": number or null,
+            "total_price": number or null
+        }
+    ]
+}"""
+
+# Boundary detection and data extraction for a whole short document in one request
+DOCUMENT_EXTRACTION_PROMPT = f"""{INVOICE_EXTRACTION_PROMPT}
+
+The attached images are consecutive pages of one document, in order, and may contain several invoices. For each page consider:
+
+{PAGE_BOUNDARY_QUESTIONS}
+
+Split the pages into invoices (each invoice is a run of consecutive pages, and every page belongs to exactly one invoice), then process each invoice on its own, using only its pages, following the instructions above.
+
+Respond ONLY with valid JSON of the form {{"invoices": [...]}}, with one entry per invoice in document order, each of the form:
+{{
+    "pages": [page numbers of the invoice, counting the first image as 1],
+    "confidence": 0.0-1.0,
+    "data": {{the invoice data in the format above}}
+}}"""
+
+
+def parse_s3_url(file_url: str) -> Optional[Tuple[str, str]]:
+    """
+    Extract the bucket and key from an S3 URL.
+    
+    Supports s3://bucket/key, virtual-hosted (bucket.s3.<region>.amazonaws.com/key)
+    and path-style (s3.<region>.amazonaws.com/bucket/key) URLs, presigned or not.
+    
+    Args:
+        file_url: URL of the object
+        
+    Returns:
+        Tuple of (bucket, key), or None if the URL does not point at S3
+    """
+    parsed = urlparse(file_url)
+    path = unquote(parsed.path.lstrip("/"))
+    
+    if parsed.scheme == "s3":
+        return (parsed.netloc, path) if parsed.netloc and path else None
+    
+    host = parsed.hostname or ""
+    if parsed.scheme not in ("http", "https") or not host.endswith(".amazonaws.com"):
+        return None
+    
+    labels = host[:-len(".amazonaws.com")].split(".")
+    if labels[0] == "s3" or labels[0].startswith("s3-"):
+        # Path-style: the bucket is the first path segment
+        bucket, _, key = path.partition("/")
+    else:
+        # Virtual-hosted style: everything before the ".s3" label is the bucket
+        s3_index = next((i for i, label in enumerate(labels) if label == "s3" or label.startswith("s3-")), None)
+        if not s3_index:
+            return None
+        bucket, key = ".".join(labels[:s3_index]), path
+    
+    return (bucket, key) if bucket and key else None
+
+
+def _content_range_total(content_range: Optional[str]) -> Optional[int]:
+    """Return the total size from a 'bytes start-end/total' Content-Range header."""
+    if not content_range or "/" not in content_range:
+        return None
+    total = content_range.rsplit("/", 1)[1]
+    return int(total) if total.isdigit() else None
+
+
+def _content_range_start(content_range: Optional[str]) -> Optional[int]:
+    """Return the first byte position from a 'bytes start-end/total' Content-Range header."""
+    if not content_range or not content_range.startswith("bytes "):
+        return None
+    start = content_range[len("bytes "):].split("-", 1)[0]
+    return int(start) if start.isdigit() else None
+
+
+def get_s3_client() -> Any:
+    """
+    Return the process-wide S3 client, creating it on first use.
+    
+    boto3 clients are thread-safe, so every InvoiceSplitter shares one client
+    and its pool of warm connections.
+    """
+    global _s3_client
+    if _s3_client is None:
+        with _s3_client_lock:
+            if _s3_client is None:
+                _s3_client = boto3.client('s3', config=S3_CLIENT_CONFIG)
+    return _s3_client
+
+
+def get_s3_transfer(max_concurrency: Optional[int] = None) -> Any:
+    """
+    Return the process-wide S3 upload transfer manager, creating it on first use.
+    
+    Uploads are submitted to its thread pool as futures, so the pool is started
+    once rather than per upload.
+    
+    Args:
+        max_concurrency: Requests in flight for the manager, if this call creates
+            it (default: S3_UPLOAD_CONFIG's)
+    """
+    global _s3_transfer
+    if _s3_transfer is None:
+        client = get_s3_client()
+        with _s3_client_lock:
+            if _s3_transfer is None:
+                config = copy.copy(S3_UPLOAD_CONFIG)
+                if max_concurrency:
+                    config.max_concurrency = max_concurrency
+                _s3_transfer = create_transfer_manager(client, config)
+    return _s3_transfer
+
+
+def encode_jpeg(image: Image.Image, max_edge: Optional[int] = None, quality: int = 85) -> bytes:
+    """Encode a page image as a baseline JPEG, downscaling it to max_edge if set."""
+    buffered = BytesIO()
+    # Convert to RGB if necessary
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    if max_edge and max(image.size) > max_edge:
+        scale = max_edge / max(image.size)
+        new_size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+        image = image.resize(new_size, Image.LANCZOS)
+    # Single-pass baseline JPEG; optimize=True costs a second Huffman pass per page
+    image.save(buffered, format="JPEG", quality=quality)
+    return buffered.getvalue()
+
+
+def _process_pool_context() -> Any:
+    """Return the multiprocessing context for worker pools."""
+    # forkserver avoids forking a process that already runs worker threads
+    method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    return multiprocessing.get_context(method)
+
+
+# Splitter of a process_batch worker process, reused for every PDF it is handed
+_batch_splitter = None
+
+
+def _init_batch_worker(splitter_class: type, splitter_kwargs: Dict[str, Any]):
+    """Process-pool initializer: build the worker's splitter and clients once."""
+    global _batch_splitter
+    _batch_splitter = splitter_class(**splitter_kwargs)
+
+
+def _process_pdf_in_worker(pdf_path: str, attachment_id: int, output_dir: Optional[str]) -> List[str]:
+    """Process-pool entry point: split one PDF with the worker's splitter."""
+    return _batch_splitter.process_pdf(pdf_path, attachment_id, output_dir)
+
+
+class _EarlyExtractor:
+    """
+    Start invoice data extraction for page groups while later pages are still analyzed.
+    
+    Pages are fed in order along with their analysis. A group is complete once a
+    later page starts a new invoice (the same rule group_pages_into_invoices
+    applies), so its extraction is submitted right away instead of after the
+    whole document has been analyzed.
+    """
+    
+    def __init__(self, extract: Callable[[List[Image.Image]], Dict], pool: ThreadPoolExecutor):
+        self.extract = extract
+        self.pool = pool
+        self.futures: Dict[Tuple[int, ...], Future] = {}  # page indices -> extraction
+        self._pages: List[int] = []
+        self._images: List[Image.Image] = []
+        self._page_count = 0
+    
+    def add_page(self, image: Image.Image, analysis: Dict):
+        """Record the next page, submitting the current group if this page starts a new invoice."""
+        if self._pages and analysis.get("is_invoice_start", False):
+            self._submit()
+        self._pages.append(self._page_count)
+        self._images.append(image)
+        self._page_count += 1
+    
+    def finish(self):
+        """Submit the last group once every page has been added."""
+        if self._pages:
+            self._submit()
+    
+    def _submit(self):
+        self.futures[tuple(self._pages)] = self.pool.submit(self.extract, self._images)
+        self._pages = []
+        self._images = []
+
 
 class InvoiceSplitter:
     """
@@ -34,19 +462,77 @@ class InvoiceSplitter:
     - Multiple invoices, multiple pages each
     """
     
-    def __init__(self, api_key: Optional[str] = None, logger: Optional[Any] = None):
+    def __init__(self, api_key: Optional[str] = None, logger: Optional[Any] = None,
+                 vision_concurrency: Optional[int] = None, llm_cache: Optional[DiskCache] = None,
+                 extraction_batch_size: Optional[int] = None, boundary_batch_size: Optional[int] = None,
+                 single_call_max_pages: Optional[int] = None, use_memory_fs: bool = False):
         """
         Initialize the invoice splitter with OpenAI API key and AWS/API configurations.
         
         Args:
             api_key: OpenAI API key (if None, reads from OPENAI_API_KEY env var)
             logger: Logger instance for logging output
+            vision_concurrency: Maximum Vision API requests in flight per document
+                (if None, reads from VISION_CONCURRENCY env var, default 8)
+            llm_cache: Cache for raw Vision API responses, keyed by request content.
+                If None, every call goes to the API.
+            extraction_batch_size: Maximum invoices extracted per Vision call
+                (if None, reads from EXTRACTION_BATCH_SIZE env var, default 1)
+            boundary_batch_size: Pages classified per boundary detection call, up to
+                MAX_IMAGES_PER_REQUEST (if None, reads from BOUNDARY_BATCH_SIZE env var, default 1)
+            single_call_max_pages: Documents with at most this many pages (up to
+                MAX_IMAGES_PER_REQUEST) are split and extracted in one Vision call
+                (if None, reads from SINGLE_CALL_MAX_PAGES env var, default 0: never)
+            use_memory_fs: Build split PDFs and JSON in memory and upload them from
+                there, writing nothing under output_dir (for Lambda's small /tmp)
         """
         self.logger = logger
         self.api_key = api_key or os.getenv("OPENAI_API_KEY")
         if not self.api_key:
             raise ValueError("OpenAI API key not found. Set OPENAI_API_KEY environment variable.")
         self.client = OpenAI(api_key=self.api_key)
+        self.vision_concurrency = max(1, vision_concurrency or int(os.getenv("VISION_CONCURRENCY", "8")))
+        self.extraction_batch_size = max(1, extraction_batch_size or int(os.getenv("EXTRACTION_BATCH_SIZE", "1")))
+        self.boundary_batch_size = min(MAX_IMAGES_PER_REQUEST,
+                                       max(1, boundary_batch_size or int(os.getenv("BOUNDARY_BATCH_SIZE", "1"))))
+        if single_call_max_pages is None:
+            single_call_max_pages = int(os.getenv("SINGLE_CALL_MAX_PAGES", "0"))
+        self.single_call_max_pages = min(MAX_IMAGES_PER_REQUEST, max(0, single_call_max_pages))
+        self.use_memory_fs = use_memory_fs
+        
+        # Invoice JSON is compact for S3 and the API, indented only when debugging
+        debug_log = os.getenv("DEBUG_LOG", "false").lower() in ("true", "1", "yes", "on")
+        self.invoice_json_option = orjson.OPT_INDENT_2 if debug_log else 0
+        
+        # Vision response cache and its hit/miss counters (shared across worker threads)
+        self.llm_cache = llm_cache
+        self.llm_cache_stats = {"hits": 0, "misses": 0}
+        self._llm_cache_lock = threading.Lock()
+        self._recent_replies: "OrderedDict[str, str]" = OrderedDict()
+        
+        # Token usage of Vision API calls (cache hits excluded), per image detail level
+        self.token_usage = {
+            detail: {"calls": 0, "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0}
+            for detail in ("low", "high")
+        }
+        self._token_usage_lock = threading.Lock()
+        
+        # JPEG encodings of live page images: (id, max_edge, quality) -> (weakref, bytes)
+        self._jpeg_cache: Dict[Tuple[int, Optional[int], int], Tuple[weakref.ref, bytes]] = {}
+        
+        # s3:// URIs of page images uploaded for VISION_IMAGE_URLS: (id, max_edge) -> (weakref, str)
+        self._image_url_cache: Dict[Tuple[int, Optional[int]], Tuple[weakref.ref, str]] = {}
+        
+        # Attachment ID -> (monotonic fetch time, metadata), oldest first
+        self._metadata_cache: "OrderedDict[int, Tuple[float, Dict]]" = OrderedDict()
+        self._metadata_cache_lock = threading.Lock()
+        
+        # One HTTP session so API calls and downloads reuse keep-alive connections
+        self.http = requests.Session()
+        adapter = HTTPAdapter(pool_connections=HTTP_POOL_CONNECTIONS, pool_maxsize=HTTP_POOL_MAXSIZE,
+                              max_retries=HTTP_RETRY)
+        self.http.mount("https://", adapter)
+        self.http.mount("http://", adapter)
         
         # API configuration
         self.api_url = os.getenv("API_URL")
@@ -59,54 +545,243 @@ class InvoiceSplitter:
             raise ValueError("S3_BUCKET_NAME environment variable not found.")
         
         # Initialize S3 client with default AWS CLI credentials
-        self.s3_client = boto3.client('s3')
+        self.s3_client = get_s3_client()
+        s3_max_concurrency = int(os.getenv("S3_MAX_CONCURRENCY") or "0")
+        if s3_max_concurrency < 0:
+            raise ValueError("S3_MAX_CONCURRENCY must not be negative.")
+        self.s3_transfer = get_s3_transfer(s3_max_concurrency or None)
         
-    def _log(self, message: str, level: str = "info"):
-        """Log message using the configured logger or print as fallback."""
+        # Send page images to the Vision API by presigned S3 URL instead of inline base64
+        self.vision_image_urls = os.getenv("VISION_IMAGE_URLS", "").lower() in ("1", "true", "yes")
+        
+    def close(self):
+        """Close the splitter's HTTP session and OpenAI client (the shared S3 client stays open)."""
+        self.http.close()
+        self.client.close()
+    
+    def __enter__(self) -> "InvoiceSplitter":
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+    
+    def _log(self, message: str, *args: Any, level: str = "info"):
+        """
+        Log message using the configured logger or print as fallback.
+        
+        Any args are %-interpolated into message only if the level is enabled,
+        so expensive values can be logged without formatting them in production.
+        """
         if self.logger:
-            if level == "error":
-                self.logger.error(message)
-            elif level == "warning":
-                self.logger.warning(message)
-            elif level == "debug":
-                self.logger.debug(message)
-            else:
-                self.logger.info(message)
+            self.logger.log(LOG_LEVELS.get(level, logging.INFO), message, *args)
+        else:
+            print(message % args if args else message)
+    
+    def _source_name(self, pdf_source: Union[str, BinaryIO]) -> str:
+        """Return a printable name for a PDF path or file object."""
+        if isinstance(pdf_source, (str, Path)):
+            return Path(pdf_source).name
+        return "<in-memory PDF>"
+    
+    def _map_vision(self, func: Callable[[Any], Any], items: List[Any]) -> List[Any]:
+        """
+        Apply a Vision API call to each item, keeping up to vision_concurrency in flight.
+        
+        Results are returned in input order. With a concurrency of 1 the calls run
+        on the calling thread (no pool to spin up, and profilers see the calls).
+        """
+        if self.vision_concurrency == 1 or len(items) <= 1:
+            return [func(item) for item in items]
+        with ThreadPoolExecutor(max_workers=min(self.vision_concurrency, len(items))) as pool:
+            return list(pool.map(func, items))
+    
+    def _open_document(self, pdf_source: Union[str, BinaryIO]) -> pymupdf.Document:
+        """Open a PDF path or file object with PyMuPDF (file objects are read into memory)."""
+        if isinstance(pdf_source, (str, Path)):
+            with _mupdf_lock:
+                return pymupdf.open(pdf_source)
+        pdf_source.seek(0)
+        pdf_bytes = pdf_source.read()
+        with _mupdf_lock:
+            return pymupdf.open(stream=pdf_bytes, filetype="pdf")
+    
+    @staticmethod
+    def _close_document(document: pymupdf.Document):
+        """Close a PyMuPDF document opened by _open_document."""
+        with _mupdf_lock:
+            document.close()
+    
+    def _render_page(self, document: pymupdf.Document, page_index: int, max_edge: int) -> Image.Image:
+        """
+        Render a page in-process so that it fits a max_edge box with its short
+        edge at most EXTRACTION_MAX_SHORT_EDGE, at no more than RENDER_MAX_DPI.
+        
+        The page is kept only as MuPDF's JPEG encoding, opened lazily by PIL, so
+        a long document holds compressed pages rather than raw pixel buffers.
+        Its encodings at max_edge and ANALYSIS_MAX_EDGE are memoized right away,
+        so the Vision calls never need to decode it again. Only the MuPDF part
+        holds the MuPDF lock; the PIL encoding runs outside it.
+        """
+        with _mupdf_lock:
+            page = document[page_index]
+            scale = min(RENDER_MAX_DPI / 72, max_edge / max(page.rect.width, page.rect.height),
+                        EXTRACTION_MAX_SHORT_EDGE / min(page.rect.width, page.rect.height))
+            pix = page.get_pixmap(matrix=pymupdf.Matrix(scale, scale), colorspace=pymupdf.csRGB, alpha=False)
+            jpeg_bytes = pix.tobytes("jpeg", jpg_quality=RENDER_JPEG_QUALITY)
+            pixels = None
+            if max(pix.width, pix.height) > ANALYSIS_MAX_EDGE:
+                pixels = Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
+            # Free MuPDF's page and pixmap while still holding the lock
+            del page, pix
+        image = Image.open(BytesIO(jpeg_bytes))
+        self._remember_encoding(image, max_edge, RENDER_JPEG_QUALITY, jpeg_bytes)
+        if pixels is None:
+            # Already small enough for boundary detection as rendered
+            self._remember_encoding(image, ANALYSIS_MAX_EDGE, RENDER_JPEG_QUALITY, jpeg_bytes)
         else:
-            print(message)
+            self._remember_encoding(image, ANALYSIS_MAX_EDGE, RENDER_JPEG_QUALITY,
+                                    encode_jpeg(pixels, ANALYSIS_MAX_EDGE, RENDER_JPEG_QUALITY))
+        return image
     
-    def check_pdf_corruption(self, pdf_path: str) -> Tuple[bool, Optional[str]]:
+    def _render_and_analyze(self, pdf_source: Union[str, BinaryIO], max_edge: int = EXTRACTION_MAX_EDGE,
+                            on_page: Optional[Callable[[Image.Image, Dict], None]] = None
+                            ) -> Tuple[List[Image.Image], Optional[List[Dict]]]:
         """
-        Check if PDF is corrupted and attempt to repair it.
+        Render a PDF and analyze pages as soon as enough of them are rendered.
+        
+        Pages are analyzed in windows of boundary_batch_size pages (one Vision
+        call per window). Vision calls for the first windows are in flight while
+        later pages render, so rendering time is mostly hidden behind API latency.
+        A single-page document is not analyzed; it always forms one invoice.
+        Documents of up to single_call_max_pages pages are only rendered (their
+        analyses are None) and left to analyze_and_extract_document.
+        Page analysis never raises, so any exception comes from rendering.
         
         Args:
-            pdf_path: Path to the PDF file
-            
+            pdf_source: PDF path or readable binary file object
+            max_edge: Longest edge of the rendered page images
+            on_page: Called with each page image and its analysis, in page order,
+                as soon as that page and all earlier ones are analyzed
+        
         Returns:
-            Tuple of (is_valid, error_message)
+            Tuple of (page images, page analyses or None), both in page order
         """
+        doc = self._open_document(pdf_source)
         try:
-            reader = PdfReader(pdf_path)
-            # Try to access pages
-            num_pages = len(reader.pages)
-            if num_pages == 0:
-                return False, "PDF has no pages"
-            # Try to access first page content
-            _ = reader.pages[0]
-            return True, None
-        except Exception as e:
-            return False, str(e)
+            with _mupdf_lock:
+                total_pages = doc.page_count
+            self._log(f"Total pages: {total_pages}")
+            
+            if total_pages == 1:
+                # A lone page is one invoice whatever its analysis says, and data
+                # extraction reads its invoice number, so skip the boundary call
+                image = self._render_page(doc, 0, max_edge)
+                analysis = {
+                    "is_invoice_start": True,
+                    "is_continuation": False,
+                    "invoice_number": None,
+                    "confidence": 1.0,
+                    "reasoning": "single-page document"
+                }
+                if on_page:
+                    on_page(image, analysis)
+                return [image], [analysis]
+            
+            if total_pages <= self.single_call_max_pages:
+                # Short documents are split together with data extraction
+                return [self._render_page(doc, page_index, max_edge) for page_index in range(total_pages)], None
+            
+            self._log("\nAnalyzing pages with GPT-4 Vision...")
+            
+            images = []
+            if self.vision_concurrency == 1:
+                # Stay on the calling thread (profilers see the calls)
+                analyses = []
+                for page_index in range(total_pages):
+                    images.append(self._render_page(doc, page_index, max_edge))
+                    if len(images) - len(analyses) == self.boundary_batch_size or len(images) == total_pages:
+                        first = len(analyses)
+                        analyses.extend(self.analyze_document_boundaries(images[first:], first + 1, total_pages))
+                        if on_page:
+                            for index in range(first, len(analyses)):
+                                on_page(images[index], analyses[index])
+                return images, analyses
+            
+            window_count = -(-total_pages // self.boundary_batch_size)
+            pool = ThreadPoolExecutor(max_workers=max(1, min(self.vision_concurrency, window_count)))
+            try:
+                windows = []  # (index of first page, future of its analyses)
+                analyses = []
+                
+                def collect(wait: bool):
+                    # Take finished windows in page order, reporting their pages
+                    while windows and (wait or windows[0][1].done()):
+                        first, future = windows.pop(0)
+                        analyses.extend(future.result())
+                        if on_page:
+                            for index in range(first, len(analyses)):
+                                on_page(images[index], analyses[index])
+                
+                analyzed = 0
+                for page_index in range(total_pages):
+                    images.append(self._render_page(doc, page_index, max_edge))
+                    if len(images) - analyzed == self.boundary_batch_size or len(images) == total_pages:
+                        windows.append((analyzed, pool.submit(self.analyze_document_boundaries,
+                                                              images[analyzed:], analyzed + 1, total_pages)))
+                        analyzed = len(images)
+                    collect(wait=False)
+                collect(wait=True)
+                return images, analyses
+            finally:
+                pool.shutdown(cancel_futures=True)
+        finally:
+            self._close_document(doc)
+    
+    def _copy_to_errors(self, pdf_source: Union[str, BinaryIO], error_file: Path):
+        """Copy a PDF path or file object into the errors folder."""
+        if isinstance(pdf_source, str):
+            # Hard-link when possible so no bytes are copied; fall back to a copy
+            # across filesystems or where links are unsupported
+            error_file.unlink(missing_ok=True)
+            try:
+                os.link(pdf_source, error_file)
+            except OSError:
+                shutil.copy2(pdf_source, error_file)
+        else:
+            pdf_source.seek(0)
+            with open(error_file, "wb") as f:
+                shutil.copyfileobj(pdf_source, f, HTTP_READ_CHUNK_SIZE)
     
-    def repair_pdf(self, pdf_path: str) -> Tuple[bool, Optional[str]]:
+    def repair_pdf(self, pdf_path: Union[str, BinaryIO]) -> Tuple[bool, Union[str, BinaryIO]]:
         """
         Attempt to repair a corrupted PDF.
         
         Args:
-            pdf_path: Path to the corrupted PDF file
+            pdf_path: Path to the corrupted PDF file or a readable binary file object
             
         Returns:
-            Tuple of (success, repaired_path or error_message)
+            Tuple of (success, repaired_path or error_message). When a file object
+            is given, the repaired PDF is returned as an in-memory buffer.
         """
+        # MuPDF rebuilds broken cross-reference tables while opening the file,
+        # so saving what it loaded is a full recovery pass in C
+        try:
+            with _mupdf_lock, self._open_document(pdf_path) as document:
+                if document.page_count == 0:
+                    return False, "Repair failed: PDF has no pages"
+                repaired_bytes = document.tobytes(garbage=3, deflate=True)
+            
+            if isinstance(pdf_path, str):
+                repaired_path = pdf_path.replace(".pdf", "_repaired.pdf")
+                with open(repaired_path, "wb") as output_file:
+                    output_file.write(repaired_bytes)
+            else:
+                repaired_path = BytesIO(repaired_bytes)
+            
+            return True, repaired_path
+        except Exception as e:
+            self._log(f"Warning: MuPDF could not repair PDF, using pypdf: {str(e)}", level="warning")
+        
         try:
             # Try to read with strict=False for more lenient parsing
             reader = PdfReader(pdf_path, strict=False)
@@ -118,18 +793,22 @@ class InvoiceSplitter:
             for page in reader.pages:
                 writer.add_page(page)
             
+            # The writer already holds every page that could be recovered, so
+            # verify from it instead of parsing the written file again
+            if len(writer.pages) == 0:
+                return False, "Repair failed: PDF has no pages"
+            
             # Save repaired PDF
-            repaired_path = pdf_path.replace(".pdf", "_repaired.pdf")
-            with open(repaired_path, "wb") as output_file:
-                writer.write(output_file)
-            
-            # Verify the repaired PDF
-            is_valid, error = self.check_pdf_corruption(repaired_path)
-            if is_valid:
-                return True, repaired_path
+            if isinstance(pdf_path, str):
+                repaired_path = pdf_path.replace(".pdf", "_repaired.pdf")
+                with open(repaired_path, "wb") as output_file:
+                    writer.write(output_file)
             else:
-                os.remove(repaired_path)
-                return False, f"Repair failed: {error}"
+                repaired_path = BytesIO()
+                writer.write(repaired_path)
+                repaired_path.seek(0)
+            
+            return True, repaired_path
         except Exception as e:
             return False, f"Repair error: {str(e)}"
     
@@ -137,24 +816,38 @@ class InvoiceSplitter:
         """
         Fetch attachment metadata from the API.
         
+        Results are reused for ATTACHMENT_METADATA_TTL seconds.
+        
         Args:
             attachment_id: ID of the attachment
             
         Returns:
             Dictionary containing attachment metadata
         """
+        with self._metadata_cache_lock:
+            cached = self._metadata_cache.get(attachment_id)
+            if cached and time.monotonic() - cached[0] < ATTACHMENT_METADATA_TTL:
+                return dict(cached[1])
+        
         try:
             url = f"{self.api_url}/api/v1/processor/attachments/{attachment_id}"
-            response = requests.get(url, timeout=30)
+            response = self.http.get(url, timeout=30)
             response.raise_for_status()
             
             data = response.json()
             if not data.get("success"):
                 raise ValueError(f"API returned success=false: {data}")
-            
-            return data.get("data")
         except requests.exceptions.RequestException as e:
             raise Exception(f"Failed to fetch attachment metadata: {str(e)}")
+        
+        metadata = data.get("data")
+        if isinstance(metadata, dict):
+            with self._metadata_cache_lock:
+                self._metadata_cache[attachment_id] = (time.monotonic(), dict(metadata))
+                self._metadata_cache.move_to_end(attachment_id)
+                while len(self._metadata_cache) > ATTACHMENT_METADATA_CACHE_SIZE:
+                    self._metadata_cache.popitem(last=False)
+        return metadata
     
     def update_attachment_status(self, attachment_id: int, status: str):
         """
@@ -167,34 +860,117 @@ class InvoiceSplitter:
         try:
             url = f"{self.api_url}/api/v1/processor/attachments/{attachment_id}"
             payload = {"status": status}
-            response = requests.patch(url, json=payload, timeout=30)
+            response = self.http.patch(url, data=orjson.dumps(payload), headers=JSON_HEADERS, timeout=30)
             response.raise_for_status()
             
             self._log(f"Updated attachment {attachment_id} status to: {status}")
         except requests.exceptions.RequestException as e:
             # Log warning but don't raise - status update failure shouldn't stop processing
-            self._log(f"Warning: Failed to update attachment status: {str(e)}", "warning")
+            self._log(f"Warning: Failed to update attachment status: {str(e)}", level="warning")
     
-    def download_pdf_from_url(self, file_url: str, output_path: str):
+    def download_pdf_from_url(self, file_url: str, output_path: Union[str, BinaryIO]):
         """
-        Download PDF from URL to local file.
+        Download PDF from URL to a local file or a writable file object.
+        
+        S3 URLs (s3://, virtual-hosted or path-style, presigned or not) are fetched
+        with a multipart boto3 download; anything else, or an S3 object the
+        configured credentials cannot read, goes through HTTP.
         
         Args:
             file_url: URL of the PDF file
-            output_path: Local path to save the PDF
+            output_path: Local path to save the PDF, or a writable binary file object
+                (e.g. a SpooledTemporaryFile) that receives the PDF bytes
         """
-        try:
-            response = requests.get(file_url, timeout=60, stream=True)
-            response.raise_for_status()
-            
+        if isinstance(output_path, (str, Path)):
             with open(output_path, 'wb') as f:
-                for chunk in response.iter_content(chunk_size=8192):
-                    f.write(chunk)
-            
+                # The file is written once front to back; let the kernel flush
+                # and read ahead accordingly
+                if hasattr(os, "posix_fadvise"):
+                    os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                self._download_to_fileobj(file_url, f)
             self._log(f"Downloaded PDF to: {output_path}")
+        else:
+            self._download_to_fileobj(file_url, output_path)
+            output_path.seek(0)
+            self._log("Downloaded PDF into temporary buffer")
+    
+    def _download_to_fileobj(self, file_url: str, fileobj: BinaryIO):
+        """Download file_url into fileobj, preferring a multipart S3 download."""
+        s3_location = parse_s3_url(file_url)
+        if s3_location:
+            bucket, key = s3_location
+            try:
+                self.s3_client.download_fileobj(bucket, key, fileobj, Config=S3_DOWNLOAD_CONFIG)
+                return
+            except (ClientError, BotoCoreError) as e:
+                if urlparse(file_url).scheme == "s3":
+                    raise Exception(f"Failed to download PDF: {str(e)}")
+                self._log(f"Warning: S3 download failed, falling back to HTTP: {str(e)}", level="warning")
+                fileobj.seek(0)
+                fileobj.truncate()
+        
+        try:
+            self._download_http(file_url, fileobj)
         except requests.exceptions.RequestException as e:
             raise Exception(f"Failed to download PDF: {str(e)}")
     
+    def _download_http(self, file_url: str, fileobj: BinaryIO):
+        """
+        Download file_url over HTTP into fileobj.
+        
+        The first request asks for the leading range only; if the server honours
+        it and the file is larger, the remaining ranges are fetched concurrently
+        straight into one preallocated buffer, which is then written in one go.
+        """
+        headers = {"Range": f"bytes=0-{HTTP_RANGE_CHUNK_SIZE - 1}", "Accept-Encoding": "identity"}
+        response = self.http.get(file_url, headers=headers, timeout=HTTP_DOWNLOAD_TIMEOUT, stream=True)
+        response.raise_for_status()
+        response.raw.decode_content = True
+        shutil.copyfileobj(response.raw, fileobj, HTTP_READ_CHUNK_SIZE)
+        
+        if response.status_code != 206:
+            # Server ignored the Range header and sent the whole file
+            return
+        
+        total_size = _content_range_total(response.headers.get("Content-Range"))
+        if not total_size or total_size <= HTTP_RANGE_CHUNK_SIZE:
+            return
+        
+        ranges = [
+            (start, min(start + HTTP_RANGE_CHUNK_SIZE, total_size) - 1)
+            for start in range(HTTP_RANGE_CHUNK_SIZE, total_size, HTTP_RANGE_CHUNK_SIZE)
+        ]
+        
+        # Each worker fills its own slice of the buffer, so no per-part bytes
+        # objects are built and parts need no reordering
+        buffer = bytearray(total_size - HTTP_RANGE_CHUNK_SIZE)
+        view = memoryview(buffer)
+        
+        def fetch_range(byte_range: Tuple[int, int]):
+            start, end = byte_range
+            range_headers = {"Range": f"bytes={start}-{end}", "Accept-Encoding": "identity"}
+            with self.http.get(file_url, headers=range_headers, timeout=HTTP_DOWNLOAD_TIMEOUT, stream=True) as part:
+                part.raise_for_status()
+                # A server may answer a later range with the whole file or another
+                # range; only the requested bytes may go into the buffer
+                if part.status_code != 206 or _content_range_start(part.headers.get("Content-Range")) != start:
+                    raise requests.exceptions.ContentDecodingError(
+                        f"Server did not return range {start}-{end} (status {part.status_code}, "
+                        f"Content-Range {part.headers.get('Content-Range')!r})")
+                offset = start - HTTP_RANGE_CHUNK_SIZE
+                limit = end + 1 - HTTP_RANGE_CHUNK_SIZE
+                for chunk in part.iter_content(HTTP_READ_CHUNK_SIZE):
+                    if offset + len(chunk) > limit:
+                        raise requests.exceptions.ContentDecodingError(f"Oversized range {start}-{end} from server")
+                    view[offset:offset + len(chunk)] = chunk
+                    offset += len(chunk)
+            if offset != limit:
+                raise requests.exceptions.ContentDecodingError(f"Incomplete range {start}-{end} from server")
+        
+        with ThreadPoolExecutor(max_workers=min(HTTP_RANGE_MAX_WORKERS, len(ranges))) as pool:
+            list(pool.map(fetch_range, ranges))
+        fileobj.write(view)
+    
     def upload_to_s3(self, file_path: str, s3_key: str, mime_type: str='binary/octet-stream') -> str:
         """
         Upload file to S3.
@@ -206,17 +982,70 @@ class InvoiceSplitter:
         Returns:
             S3 key of the uploaded file
         """
+        return self.upload_many([(file_path, s3_key, mime_type)])[0]
+    
+    def upload_many(self, jobs: List[Tuple[Union[str, Path, bytes], str, str]]) -> List[str]:
+        """
+        Upload several files to S3 concurrently.
+        
+        All uploads are submitted to the shared transfer manager before waiting
+        on any of them.
+        
+        Args:
+            jobs: (file_path, s3_key, mime_type) tuples; file_path may also be
+                the file's bytes, which are uploaded from memory
+        Returns:
+            S3 keys of the uploaded files, in job order
+        """
+        futures = [
+            self.s3_transfer.upload(BytesIO(source) if isinstance(source, bytes) else str(source),
+                                    self.s3_bucket_name, s3_key, extra_args={'ContentType': mime_type})
+            for source, s3_key, mime_type in jobs
+        ]
         try:
-            with open(file_path, 'rb') as f:
-                self.s3_client.upload_fileobj(f, self.s3_bucket_name, s3_key, ExtraArgs={'ContentType': mime_type})
-            
-            self._log(f"    Uploaded to S3: {s3_key}")
-            return s3_key
-        except ClientError as e:
+            for future, (_, s3_key, _) in zip(futures, jobs):
+                future.result()
+                self._log(f"    Uploaded to S3: {s3_key}")
+        except (ClientError, BotoCoreError) as e:
             raise Exception(f"Failed to upload to S3: {str(e)}")
+        return [s3_key for _, s3_key, _ in jobs]
+    
+    def publish_invoice(self, invoice_data: Dict, attachment_id: int, pdf_path: Path, json_path: Path,
+                        json_payload: Optional[bytes] = None, pdf_payload: Optional[bytes] = None) -> bool:
+        """
+        Upload an invoice's PDF and JSON files to S3 and create its invoice record.
+        
+        Failures are logged as warnings rather than raised, so one invoice cannot
+        fail the rest of its document.
+        
+        Args:
+            invoice_data: Extracted invoice data
+            attachment_id: ID of the source attachment
+            pdf_path: Local invoice PDF
+            json_path: Local invoice JSON
+            json_payload: Contents of json_path, uploaded from memory instead of
+                reading the file back (read from json_path if None)
+            pdf_payload: Contents of pdf_path, likewise (read from pdf_path if None)
+        Returns:
+            True if both files were uploaded and the invoice record was created
+        """
+        try:
+            pdf_s3_key = f"invoices/{attachment_id}/{pdf_path.name}"
+            json_s3_key = f"invoices/{attachment_id}/{json_path.name}"
+            
+            self.upload_many([
+                (pdf_payload if pdf_payload is not None else str(pdf_path), pdf_s3_key, "application/pdf"),
+                (json_payload if json_payload is not None else str(json_path), json_s3_key, "application/json"),
+            ])
+            
+            # Create/update invoice record in database
+            return self.create_invoice_record(invoice_data, attachment_id, pdf_s3_key, json_s3_key)
+        except Exception as e:
+            self._log(f"    Warning: S3 upload or API call failed for {pdf_path.name}: {e}", level="warning")
+            return False
     
     def create_invoice_record(self, invoice_data: Dict, attachment_id: int, 
-                            s3_pdf_key: str, s3_json_key: str):
+                            s3_pdf_key: str, s3_json_key: str) -> bool:
         """
         Create invoice record in database via API.
         
@@ -225,6 +1054,8 @@ class InvoiceSplitter:
             attachment_id: ID of the source attachment
             s3_pdf_key: S3 key of the uploaded PDF
             s3_json_key: S3 key of the uploaded JSON
+        Returns:
+            True if the record was created
         """
         # Prepare payload with all invoice data plus additional fields
         payload = {
@@ -234,24 +1065,188 @@ class InvoiceSplitter:
             "s3_json_key": s3_json_key
         }
         try:
-            
-            response = requests.post(f"{self.api_url}/api/v1/processor/invoices", json=payload, timeout=30)
+            body = orjson.dumps(payload)
+            for attempt in range(RECORD_POST_ATTEMPTS):
+                response = self.http.post(f"{self.api_url}/api/v1/processor/invoices", data=body,
+                                          headers=JSON_HEADERS, timeout=30)
+                if response.status_code not in RECORD_POST_RETRY_STATUSES or attempt == RECORD_POST_ATTEMPTS - 1:
+                    break
+                delay = 2 ** attempt
+                retry_after = response.headers.get("Retry-After", "")
+                if retry_after.isdigit():
+                    delay = min(max(delay, int(retry_after)), RECORD_POST_MAX_RETRY_DELAY)
+                self._log(f"    Invoice API returned {response.status_code}, retrying in {delay}s", level="warning")
+                time.sleep(delay)
             response.raise_for_status()
             
             self._log(f"    Created invoice record in database")
+            return True
         except requests.exceptions.RequestException as e:
             # Log error but don't raise - continue processing other invoices
-            self._log(f"    Warning: Failed to create invoice record: {str(e)}", "warning")
-    
-    def image_to_base64(self, image: Image.Image) -> str:
-        """Convert PIL Image to base64 string."""
-        buffered = BytesIO()
-        # Convert to RGB if necessary
-        if image.mode != 'RGB':
-            image = image.convert('RGB')
-        image.save(buffered, format="JPEG", quality=85)
-        img_str = base64.b64encode(buffered.getvalue()).decode()
-        return img_str
+            self._log(f"    Warning: Failed to create invoice record: {str(e)}", level="warning")
+            return False
+    
+    def image_to_jpeg(self, image: Image.Image, max_edge: Optional[int] = None, quality: int = 85) -> bytes:
+        """
+        Convert PIL Image to JPEG bytes.
+        
+        Encodings are memoized per image and settings for as long as the image
+        is alive, so a page sent in several requests is only encoded once.
+        
+        Args:
+            image: Page image (left unmodified)
+            max_edge: If set, downscale so the longest edge is at most this many pixels
+            quality: JPEG quality
+        """
+        cache_key = (id(image), max_edge, quality)
+        cached = self._jpeg_cache.get(cache_key)
+        if cached and cached[0]() is image:
+            return cached[1]
+        
+        jpeg_bytes = encode_jpeg(image, max_edge, quality)
+        self._remember_encoding(image, max_edge, quality, jpeg_bytes)
+        return jpeg_bytes
+    
+    def image_to_base64(self, image: Image.Image, max_edge: Optional[int] = None, quality: int = 85) -> str:
+        """Convert PIL Image to base64 JPEG string (the JPEG encoding is memoized, see image_to_jpeg)."""
+        return base64.b64encode(self.image_to_jpeg(image, max_edge, quality)).decode("ascii")
+    
+    @staticmethod
+    def _memoize_for_image(cache: Dict, cache_key: Tuple, image: Image.Image, value: Any):
+        """Store a value derived from a page image in a per-image memo."""
+        # Keyed by id() since PIL images are unhashable; the weakref both guards
+        # against id reuse and drops the entry once the page image is freed
+        cache[cache_key] = (weakref.ref(image, lambda _, key=cache_key: cache.pop(key, None)), value)
+    
+    def _remember_encoding(self, image: Image.Image, max_edge: Optional[int], quality: int, jpeg_bytes: bytes):
+        """Store a JPEG encoding in the per-image memo."""
+        self._memoize_for_image(self._jpeg_cache, (id(image), max_edge, quality), image, jpeg_bytes)
+    
+    def image_to_url(self, image: Image.Image, max_edge: Optional[int] = None) -> str:
+        """
+        Return a reference to a page image for a Vision API request.
+        
+        By default this is an inline base64 data URL. With VISION_IMAGE_URLS
+        enabled the JPEG is uploaded under VISION_IMAGE_PREFIX, keyed by its
+        SHA-256, and an s3:// URI is returned; _chat_completion presigns it
+        just before sending, so the LLM cache key stays stable. Each image is
+        uploaded once per size while it is alive.
+        """
+        if not self.vision_image_urls:
+            return f"data:image/jpeg;base64,{self.image_to_base64(image, max_edge=max_edge)}"
+        
+        cache_key = (id(image), max_edge)
+        cached = self._image_url_cache.get(cache_key)
+        if cached and cached[0]() is image:
+            return cached[1]
+        
+        jpeg_bytes = self.image_to_jpeg(image, max_edge=max_edge)
+        s3_key = f"{VISION_IMAGE_PREFIX}{hashlib.sha256(jpeg_bytes).hexdigest()}.jpg"
+        try:
+            self.s3_client.put_object(Bucket=self.s3_bucket_name, Key=s3_key, Body=jpeg_bytes,
+                                      ContentType="image/jpeg")
+        except ClientError as e:
+            raise Exception(f"Failed to upload page image to S3: {str(e)}")
+        image_url = f"s3://{self.s3_bucket_name}/{s3_key}"
+        self._memoize_for_image(self._image_url_cache, cache_key, image, image_url)
+        return image_url
+    
+    def _chat_completion(self, prompt: str, image_urls: List[str], max_tokens: int, detail: str = "high") -> str:
+        """
+        Send a prompt with page images to the Vision model and return the reply text.
+        
+        Replies are remembered in memory (the last LLM_MEMORY_CACHE_SIZE) under a
+        SHA-256 of the request (model, prompt, images and parameters), so an
+        identical page group sent again by this splitter is answered without a
+        call. When an LLM cache is configured, the full raw response is also
+        stored on disk under the same key and replayed on identical requests.
+        
+        Args:
+            prompt: Text prompt
+            image_urls: Page image references from image_to_url, in page order
+            max_tokens: Maximum tokens in the reply
+            detail: Vision detail level for the images ("high" or "low")
+            
+        Returns:
+            Reply text from the model (a JSON object, as JSON mode is enabled)
+        """
+        content = [{"type": "text", "text": prompt}]
+        for image_url in image_urls:
+            content.append({
+                "type": "image_url",
+                "image_url": {
+                    "url": image_url,
+                    "detail": detail
+                }
+            })
+        request = {
+            "model": VISION_MODEL,
+            "messages": [{"role": "user", "content": content}],
+            "max_tokens": max_tokens,
+            "temperature": 0.1,
+            # JSON mode: the reply is always a single valid JSON object, never fenced
+            "response_format": {"type": "json_object"},
+        }
+        
+        cache_key = hashlib.sha256(orjson.dumps(request, option=orjson.OPT_SORT_KEYS)).hexdigest()
+        with self._llm_cache_lock:
+            reply = self._recent_replies.get(cache_key)
+            if reply is not None:
+                self._recent_replies.move_to_end(cache_key)
+                self.llm_cache_stats["hits"] += 1
+                return reply
+        
+        if self.llm_cache:
+            cached = self.llm_cache.get_json("openai", cache_key)
+            with self._llm_cache_lock:
+                self.llm_cache_stats["hits" if cached is not None else "misses"] += 1
+            if cached is not None:
+                reply = cached["choices"][0]["message"]["content"]
+                self._remember_reply(cache_key, reply)
+                return reply
+        
+        # Presign S3 image references only once a real call is needed
+        for part in content[1:]:
+            s3_location = parse_s3_url(part["image_url"]["url"])
+            if s3_location:
+                part["image_url"]["url"] = self.s3_client.generate_presigned_url(
+                    "get_object",
+                    Params={"Bucket": s3_location[0], "Key": s3_location[1]},
+                    ExpiresIn=VISION_IMAGE_URL_EXPIRY,
+                )
+        
+        response = self.client.chat.completions.create(**request)
+        self._record_usage(detail, response.usage)
+        
+        if self.llm_cache:
+            self.llm_cache.set_json("openai", cache_key, response.model_dump(mode="json"))
+        reply = response.choices[0].message.content
+        self._remember_reply(cache_key, reply)
+        return reply
+    
+    def _remember_reply(self, cache_key: str, reply: str):
+        """Keep a Vision reply in the in-memory LRU, evicting the oldest entries."""
+        if reply is None:
+            return
+        with self._llm_cache_lock:
+            self._recent_replies[cache_key] = reply
+            self._recent_replies.move_to_end(cache_key)
+            while len(self._recent_replies) > LLM_MEMORY_CACHE_SIZE:
+                self._recent_replies.popitem(last=False)
+    
+    def _record_usage(self, detail: str, usage: Any):
+        """Add a Vision API response's token usage to the per-detail totals."""
+        if usage is None:
+            return
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached_tokens = getattr(details, "cached_tokens", None) or 0
+        with self._token_usage_lock:
+            totals = self.token_usage.setdefault(
+                detail, {"calls": 0, "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0})
+            totals["calls"] += 1
+            totals["prompt_tokens"] += usage.prompt_tokens
+            totals["cached_tokens"] += cached_tokens
+            totals["completion_tokens"] += usage.completion_tokens
     
     def analyze_page_with_vision(self, image: Image.Image, page_num: int, total_pages: int) -> Dict:
         """
@@ -265,63 +1260,19 @@ class InvoiceSplitter:
         Returns:
             Dict with keys: is_invoice_start, is_continuation, invoice_number, confidence
         """
-        base64_image = self.image_to_base64(image)
-        
-        prompt = f"""Analyze this document page (page {page_num} of {total_pages}) and determine:
-
-1. Does this page START a new invoice? (Look for invoice headers, invoice numbers, "INVOICE" title, billing/shipping addresses at top)
-2. Is this page a CONTINUATION of a previous invoice? (Look for "continued from previous page", partial tables, no invoice header)
-3. What is the invoice number/identifier if visible? (e.g., "INV-12345", "Invoice #67890")
-
-Consider these patterns:
-- New invoice pages typically have: Invoice header/title, invoice number prominently displayed, billing "From" and "To" addresses, invoice date
-- Continuation pages typically have: Itemized lists continuing, page numbers like "Page 2 of 3", no invoice header/number, table rows continuing
-- Some invoices may have multiple invoices on one page (rare but possible)
-
-Respond ONLY with valid JSON in this exact format:
-{{
-    "is_invoice_start": true/false,
-    "is_continuation": true/false,
-    "invoice_number": "string or null",
-    "confidence": 0.0-1.0,
-    "reasoning": "brief explanation"
-}}"""
+        prompt = f"{PAGE_ANALYSIS_PROMPT}\n\nContext: this is page {page_num} of {total_pages}."
 
         try:
-            response = self.client.chat.completions.create(
-                model="gpt-4o",
-                messages=[
-                    {
-                        "role": "user",
-                        "content": [
-                            {"type": "text", "text": prompt},
-                            {
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": f"data:image/jpeg;base64,{base64_image}",
-                                    "detail": "high"
-                                }
-                            }
-                        ]
-                    }
-                ],
-                max_tokens=500,
-                temperature=0.1
-            )
-            
-            result_text = response.choices[0].message.content.strip()
-            
-            # Extract JSON from response (handle markdown code blocks)
-            if "```json" in result_text:
-                result_text = result_text.split("```json")[1].split("```")[0].strip()
-            elif "```" in result_text:
-                result_text = result_text.split("```")[1].split("```")[0].strip()
-            
-            result = json.loads(result_text)
+            image_url = self.image_to_url(image, max_edge=ANALYSIS_MAX_EDGE)
+            
+            # Boundary detection only needs the page layout, so low detail is enough
+            result_text = self._chat_completion(prompt, [image_url], max_tokens=BOUNDARY_MAX_TOKENS, detail="low")
+            
+            result = orjson.loads(result_text)
             return result
             
         except Exception as e:
-            self._log(f"  Warning: Vision API error on page {page_num}: {str(e)}", "warning")
+            self._log(f"  Warning: Vision API error on page {page_num}: {str(e)}", level="warning")
             # Fallback: assume each page is a new invoice if we can't analyze
             return {
                 "is_invoice_start": True,
@@ -331,6 +1282,47 @@ Respond ONLY with valid JSON in this exact format:
                 "reasoning": f"API error: {str(e)}"
             }
     
+    def analyze_document_boundaries(self, images: List[Image.Image], first_page: int,
+                                    total_pages: int) -> List[Dict]:
+        """
+        Classify a run of consecutive pages with a single Vision API call.
+        
+        Seeing neighbouring pages together also helps the model tell a new
+        invoice from a continuation. If the reply does not hold one result per
+        page, the pages are analyzed one by one instead.
+        
+        Args:
+            images: Page images in order (at most MAX_IMAGES_PER_REQUEST)
+            first_page: Page number of the first image (1-indexed)
+            total_pages: Total number of pages in the document
+        
+        Returns:
+            List of page analyses in the format of analyze_page_with_vision, one per image
+        """
+        if len(images) == 1:
+            return [self.analyze_page_with_vision(images[0], first_page, total_pages)]
+        
+        last_page = first_page + len(images) - 1
+        prompt = (f"{DOCUMENT_BOUNDARY_PROMPT}\n\nContext: the {len(images)} images are pages "
+                  f"{first_page}-{last_page} of {total_pages}; reply with exactly {len(images)} entries.")
+
+        try:
+            image_urls = [self.image_to_url(image, max_edge=ANALYSIS_MAX_EDGE) for image in images]
+            result_text = self._chat_completion(prompt, image_urls,
+                                                max_tokens=BOUNDARY_TOKENS_PER_PAGE * len(images), detail="low")
+            
+            pages = orjson.loads(result_text).get("pages")
+            if not isinstance(pages, list) or len(pages) != len(images) \
+                    or not all(isinstance(page, dict) for page in pages):
+                raise ValueError(f"expected {len(images)} pages in boundary reply")
+            return pages
+            
+        except Exception as e:
+            self._log(f"  Warning: Boundary detection failed for pages {first_page}-{last_page}, "
+                      f"analyzing pages one by one: {str(e)}", level="warning")
+            return [self.analyze_page_with_vision(image, page_num, total_pages)
+                    for page_num, image in enumerate(images, start=first_page)]
+    
     def group_pages_into_invoices(self, analyses: List[Dict]) -> List[List[int]]:
         """
         Group page numbers into invoice groups based on AI analysis.
@@ -374,103 +1366,17 @@ Respond ONLY with valid JSON in this exact format:
         Returns:
             Dictionary with structured invoice data
         """
-        # Convert all images to base64 for multi-page invoices
-        base64_images = [self.image_to_base64(img) for img in images]
-        
-        # Create the prompt for data extraction
-        prompt = """Analyze this invoice document and extract all relevant information.
-
-For multi-page invoices, combine information from all pages.
-
-Extract and return the following information in JSON format:
-
-1. invoice_number: The invoice number/identifier
-2. customer_name: The customer/buyer name (the "Bill To" or recipient)
-3. vendor_name: The vendor/seller name (the "From" or issuer)
-4. vendor_address: The vendor/seller address (the "From" or issuer address)
-5. vendor_phone: The vendor/seller phone number (the "From" or issuer phone number)
-6. vendor_email: The vendor/seller email address (the "From" or issuer email address)
-7. invoice_date: Invoice date in YYYY-MM-DD format
-8. due_date: Payment due date in YYYY-MM-DD format (if available)
-9. total_amount: Total invoice amount as a number
-10. currency: Currency code (USD, EUR, etc.)
-11. total_tax: Total tax amount as a number
-12. description: Brief description or summary of the invoice
-13. line_items: Array of items with:
-   - item_name: Name/description of the item/service
-   - quantity: Quantity ordered
-   - unit_price: Price per unit (null if not available)
-   - total_price: Total price for this line item
-
-Important:
-- If a field is not found, use null
-- For line_items, extract ALL items across all pages
-- Ensure amounts are numbers, not strings
-- Use YYYY-MM-DD format for dates
-
-Respond ONLY with valid JSON in this exact format:
-{
-    "invoice_number": "string or null",
-    "customer_name": "string or null",
-    "vendor_name": "string or null",
-    "vendor_address": "string or null",
-    "vendor_phone": "string or null",
-    "vendor_email": "string or null",
-    "invoice_date": "YYYY-MM-DD or null",
-    "due_date": "YYYY-MM-DD or null",
-    "total_amount": number or null,
-    "currency": "string or null",
-    "total_tax": number or null,
-    "description": "string or null",
-    "line_items": [
-        {
-            "item_name": "string",
-            "quantity": number or null,
-            "unit_price": number or null,
-            "total_price": number or null
-        }
-    ]
-}"""
-
         try:
-            # Build message content with all images
-            content = [{"type": "text", "text": prompt}]
-            
-            # Add all page images
-            for img_b64 in base64_images:
-                content.append({
-                    "type": "image_url",
-                    "image_url": {
-                        "url": f"data:image/jpeg;base64,{img_b64}",
-                        "detail": "high"
-                    }
-                })
-            
-            response = self.client.chat.completions.create(
-                model="gpt-4o",
-                messages=[
-                    {
-                        "role": "user",
-                        "content": content
-                    }
-                ],
-                max_tokens=2000,
-                temperature=0.1
-            )
-            
-            result_text = response.choices[0].message.content.strip()
-            
-            # Extract JSON from response
-            if "```json" in result_text:
-                result_text = result_text.split("```json")[1].split("```")[0].strip()
-            elif "```" in result_text:
-                result_text = result_text.split("```")[1].split("```")[0].strip()
-            
-            invoice_data = json.loads(result_text)
+            # Encode (or upload) all page images for multi-page invoices
+            image_urls = [self.image_to_url(img, max_edge=EXTRACTION_MAX_EDGE) for img in images]
+            
+            result_text = self._chat_completion(INVOICE_EXTRACTION_PROMPT, image_urls, max_tokens=EXTRACTION_MAX_TOKENS)
+            
+            invoice_data = orjson.loads(result_text)
             return invoice_data
             
         except Exception as e:
-            self._log(f"    Warning: Error extracting invoice data: {str(e)}", "warning")
+            self._log(f"    Warning: Error extracting invoice data: {str(e)}", level="warning")
             # Return empty structure if extraction fails
             return {
                 "invoice_number": None,
@@ -489,355 +1395,469 @@ Respond ONLY with valid JSON in this exact format:
                 "extraction_error": str(e)
             }
     
-    def find_existing_invoice_file(self, output_dir: Path, invoice_number: str) -> Optional[Tuple[Path, Path]]:
+    def extract_invoices_batch(self, groups: List[List[Image.Image]]) -> List[Dict]:
         """
-        Find existing JSON and PDF files for a given invoice number.
+        Extract structured data for several invoices with a single Vision call.
+        
+        Falls back to one extract_invoice_data call per invoice if the reply does
+        not contain exactly one result per invoice.
         
         Args:
-            output_dir: Directory to search for files
-            invoice_number: Invoice number to search for
+            groups: Page images for each invoice, in document order
             
         Returns:
-            Tuple of (json_path, pdf_path) if found, None otherwise
+            List of invoice data dictionaries, one per group
         """
-        # Sanitize invoice number for filename matching
-        safe_invoice_num = "".join(c for c in invoice_number if c.isalnum() or c in "-_")
+        if len(groups) == 1:
+            return [self.extract_invoice_data(groups[0])]
         
-        # Search for JSON files that might contain this invoice number
-        for json_file in output_dir.glob("*_invoice_*.json"):
-            try:
-                with open(json_file, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    if data.get("invoice_number") == invoice_number:
-                        # Found a match, return both JSON and PDF paths
-                        pdf_file = json_file.with_suffix('.pdf')
-                        if pdf_file.exists():
-                            return (json_file, pdf_file)
-            except (json.JSONDecodeError, Exception) as e:
-                self._log(f"    Warning: Could not read {json_file.name}: {e}", "warning")
-                continue
+        try:
+            image_urls = []
+            group_lines = []
+            for number, group in enumerate(groups, start=1):
+                first_image = len(image_urls) + 1
+                image_urls.extend(self.image_to_url(img, max_edge=EXTRACTION_MAX_EDGE) for img in group)
+                if first_image == len(image_urls):
+                    group_lines.append(f"Invoice {number}: image {first_image}")
+                else:
+                    group_lines.append(f"Invoice {number}: images {first_image}-{len(image_urls)}")
+            
+            prompt = f"""{INVOICE_EXTRACTION_PROMPT}
+
+The attached images contain {len(groups)} separate invoices, in this order:
+{chr(10).join(group_lines)}
+
+Process each invoice on its own, using only its images, following the instructions above.
+
+Respond ONLY with valid JSON of the form {{"results": [...]}}, where "results" holds exactly {len(groups)} objects in the format above, in invoice order."""
+
+            max_tokens = min(EXTRACTION_MAX_TOKENS * len(groups), EXTRACTION_BATCH_MAX_TOKENS)
+            result_text = self._chat_completion(prompt, image_urls, max_tokens=max_tokens)
+            
+            results = orjson.loads(result_text).get("results")
+            if not isinstance(results, list) or len(results) != len(groups) \
+                    or not all(isinstance(result, dict) for result in results):
+                raise ValueError(f"expected {len(groups)} results in batched reply")
+            return results
+            
+        except Exception as e:
+            self._log(f"    Warning: Batched extraction failed, extracting invoices one by one: {str(e)}", level="warning")
+            return self._map_vision(self.extract_invoice_data, groups)
+    
+    def analyze_and_extract_document(self, images: List[Image.Image]
+                                     ) -> Optional[Tuple[List[Dict], List[List[int]], List[Dict]]]:
+        """
+        Split a short document into invoices and extract them with a single Vision call.
         
-        return None
+        Args:
+            images: Page images of the whole document, in page order
+            
+        Returns:
+            Tuple of (page analyses, invoice groups of 0-indexed pages, invoice data
+            per group), or None if the call failed or its invoices do not cover
+            every page exactly once, in order
+        """
+        prompt = f"{DOCUMENT_EXTRACTION_PROMPT}\n\nContext: the document has {len(images)} pages."
+        try:
+            image_urls = [self.image_to_url(img, max_edge=EXTRACTION_MAX_EDGE) for img in images]
+            max_tokens = min(EXTRACTION_MAX_TOKENS * len(images), EXTRACTION_BATCH_MAX_TOKENS)
+            result_text = self._chat_completion(prompt, image_urls, max_tokens=max_tokens)
+            
+            invoices = orjson.loads(result_text).get("invoices")
+            if not isinstance(invoices, list) or not invoices:
+                raise ValueError("no invoices in reply")
+            invoice_groups = []
+            extracted_invoices = []
+            analyses = []
+            for invoice in invoices:
+                pages = invoice.get("pages") if isinstance(invoice, dict) else None
+                data = invoice.get("data") if isinstance(invoice, dict) else None
+                if not isinstance(pages, list) or not pages or not isinstance(data, dict):
+                    raise ValueError("invoice entry without pages or data")
+                group = [len(analyses) + offset for offset in range(len(pages))]
+                if pages != [page + 1 for page in group]:
+                    raise ValueError(f"invoice pages {pages} do not continue the document")
+                invoice_groups.append(group)
+                extracted_invoices.append(data)
+                confidence = invoice.get("confidence")
+                for page in group:
+                    analyses.append({
+                        "is_invoice_start": page == group[0],
+                        "is_continuation": page != group[0],
+                        "invoice_number": data.get("invoice_number") if page == group[0] else None,
+                        "confidence": confidence if isinstance(confidence, (int, float)) else 0.0,
+                        "reasoning": "classified together with data extraction"
+                    })
+            if len(analyses) != len(images):
+                raise ValueError(f"invoices cover {len(analyses)} of {len(images)} pages")
+            return analyses, invoice_groups, extracted_invoices
+            
+        except Exception as e:
+            self._log(f"  Warning: Single-call extraction failed, analyzing pages separately: {str(e)}", level="warning")
+            return None
     
-    def merge_invoice_data(self, existing_data: Dict, new_data: Dict) -> Dict:
+    def _batch_invoice_groups(self, invoice_groups: List[List[int]]) -> List[List[List[int]]]:
+        """Split page groups into extraction batches bounded by invoice and image counts."""
+        batches = []
+        current = []
+        current_images = 0
+        for page_group in invoice_groups:
+            if current and (len(current) >= self.extraction_batch_size
+                            or current_images + len(page_group) > MAX_IMAGES_PER_REQUEST):
+                batches.append(current)
+                current = []
+                current_images = 0
+            current.append(page_group)
+            current_images += len(page_group)
+        if current:
+            batches.append(current)
+        return batches
+    
+    def merge_invoice_data(self, existing_data: Dict, new_data: Dict, *, in_place: bool = False) -> Dict:
         """
         Merge new invoice data into existing invoice data.
         
         Args:
             existing_data: Existing invoice data dictionary
             new_data: New invoice data to merge
+            in_place: Update existing_data itself instead of a copy (for callers
+                that discard the original)
             
         Returns:
             Merged invoice data dictionary
         """
-        merged = existing_data.copy()
+        if in_place:
+            merged = existing_data
+        else:
+            merged = existing_data.copy()
+            # Copy the list too so appending never changes existing_data
+            if merged.get("line_items"):
+                merged["line_items"] = list(merged["line_items"])
         
         # Always append line items
         if new_data.get("line_items"):
             if not merged.get("line_items"):
                 merged["line_items"] = []
-            merged["line_items"].extend(new_data["line_items"])
+            merged["line_items"] += new_data["line_items"]
         
         # Update other fields only if existing field is null/None/empty and new has value
-        for field in ["customer_name", "vendor_name", "vendor_address", "vendor_phone", "vendor_email", "invoice_date", "due_date", 
-                      "total_amount", "currency", "total_tax", "description", "invoice_number"]:
-            existing_value = merged.get(field)
-            new_value = new_data.get(field)
-            
-            # Check if existing is null/None/empty
-            if not existing_value and new_value:
-                merged[field] = new_value
+        for field in INVOICE_SCALAR_FIELDS:
+            if not merged.get(field):
+                new_value = new_data.get(field)
+                if new_value:
+                    merged[field] = new_value
         
         return merged
     
-    def merge_pdf_files(self, existing_pdf: str, new_pages_source: str, new_page_indices: List[int]):
+    @staticmethod
+    def _output_target(output_path: Union[str, BinaryIO]):
+        """Context for writing to output_path: an atomic temp path for paths, else the file object itself."""
+        if isinstance(output_path, (str, Path)):
+            return atomic_output_path(output_path)
+        return nullcontext(output_path)
+    
+    def extract_pages_to_pdf(self, input_pdf: Union[str, BinaryIO], page_indices: List[int],
+                             output_path: Union[str, BinaryIO], document: Optional[pymupdf.Document] = None):
         """
-        Merge new pages into an existing PDF file.
+        Extract specific pages from input PDF and save to new PDF.
+        
+        Pages are copied with PyMuPDF, one insert_pdf call per run of consecutive
+        pages; pypdf is used instead if MuPDF cannot copy them.
         
         Args:
-            existing_pdf: Path to existing PDF file to append to
-            new_pages_source: Path to source PDF containing new pages
-            new_page_indices: List of 0-indexed page numbers to append
+            input_pdf: Path to input PDF or a readable binary file object
+            page_indices: List of 0-indexed page numbers to extract
+            output_path: Path for output PDF, or an empty writable binary file object
+            document: Already-open PyMuPDF document for input_pdf (opened here if None)
         """
+        self._log("    DEBUG: Extracting pages %s from %s", page_indices, self._source_name(input_pdf), level="debug")
+        own_document = document is None
         try:
-            # Read existing PDF
-            existing_reader = PdfReader(existing_pdf, strict=False)
-            
-            # Read source PDF with new pages
-            source_reader = PdfReader(new_pages_source, strict=False)
-            
-            # Create writer and add all existing pages first
-            writer = PdfWriter()
-            for page in existing_reader.pages:
-                writer.add_page(page)
+            if own_document:
+                document = self._open_document(input_pdf)
+            with _mupdf_lock:
+                page_count = document.page_count
             
-            # Add new pages
-            for page_idx in new_page_indices:
-                if page_idx < len(source_reader.pages):
-                    writer.add_page(source_reader.pages[page_idx])
-            
-            # Write back to the existing file
-            with open(existing_pdf, "wb") as output_file:
-                writer.write(output_file)
-            
-            self._log(f"    Merged {len(new_page_indices)} new pages into existing PDF")
+            # An invoice spanning the whole document in order is the source itself;
+            # copy its bytes rather than rebuilding it page by page
+            if list(page_indices) == list(range(page_count)):
+                with self._output_target(output_path) as target:
+                    if isinstance(input_pdf, str) and isinstance(target, str):
+                        shutil.copyfile(input_pdf, target)
+                    elif isinstance(input_pdf, str):
+                        with open(input_pdf, "rb") as input_file:
+                            shutil.copyfileobj(input_file, target, HTTP_READ_CHUNK_SIZE)
+                    else:
+                        input_pdf.seek(0)
+                        if isinstance(target, str):
+                            with open(target, "wb") as output_file:
+                                shutil.copyfileobj(input_pdf, output_file, HTTP_READ_CHUNK_SIZE)
+                        else:
+                            shutil.copyfileobj(input_pdf, target, HTTP_READ_CHUNK_SIZE)
+                self._log("    DEBUG: Copied source PDF unchanged (%d pages)", len(page_indices), level="debug")
+                return
             
+            pages = [page_idx for page_idx in page_indices if page_idx < page_count]
+            with _mupdf_lock:
+                output = pymupdf.open()
+                try:
+                    run_start = 0
+                    for run_end in range(1, len(pages) + 1):
+                        if run_end == len(pages) or pages[run_end] != pages[run_end - 1] + 1:
+                            output.insert_pdf(document, from_page=pages[run_start], to_page=pages[run_end - 1])
+                            run_start = run_end
+                    # garbage=3 also merges resources duplicated by separate runs
+                    with self._output_target(output_path) as target:
+                        output.save(target, garbage=3, deflate=True)
+                    output_pages = output.page_count
+                finally:
+                    output.close()
+            self._log("    DEBUG: Output PDF has %d pages", output_pages, level="debug")
+            return
         except Exception as e:
-            self._log(f"    Error merging PDF files: {e}", "error")
-            raise
-    
-    def extract_pages_to_pdf(self, input_pdf: str, page_indices: List[int], output_path: str):
-        """
-        Extract specific pages from input PDF and save to new PDF.
+            self._log(f"    Warning: MuPDF could not extract pages, using pypdf: {str(e)}", level="warning")
+        finally:
+            if own_document and document is not None:
+                self._close_document(document)
         
-        Args:
-            input_pdf: Path to input PDF
-            page_indices: List of 0-indexed page numbers to extract
-            output_path: Path for output PDF
-        """
-        self._log(f"    DEBUG: Extracting pages {page_indices} from {Path(input_pdf).name}", "debug")
         reader = PdfReader(input_pdf, strict=False)
         writer = PdfWriter()
         
-        pages_added = 0
         for page_idx in page_indices:
             if page_idx < len(reader.pages):
                 writer.add_page(reader.pages[page_idx])
-                pages_added += 1
         
-        self._log(f"    DEBUG: Added {pages_added} pages to output PDF", "debug")
+        if not isinstance(output_path, (str, Path)):
+            # Drop anything MuPDF wrote before it failed
+            output_path.seek(0)
+            output_path.truncate()
+        with self._output_target(output_path) as target:
+            writer.write(target)
         
-        with open(output_path, "wb") as output_file:
-            writer.write(output_file)
-        
-        # Verify the output
-        verify_reader = PdfReader(output_path, strict=False)
-        self._log(f"    DEBUG: Output PDF has {len(verify_reader.pages)} pages", "debug")
+        # The writer knows what it wrote; no need to parse the output again
+        self._log("    DEBUG: Output PDF has %d pages", writer.get_num_pages(), level="debug")
     
-    def process_pdf(self, pdf_path: str, attachment_id: int, output_dir: Optional[str] = None) -> List[str]:
+    def process_pdf(self, pdf_path: Union[str, Path, BinaryIO], attachment_id: int,
+                    output_dir: Optional[str] = None, filename: Optional[str] = None,
+                    unpublished: Optional[List[str]] = None) -> List[str]:
         """
         Main processing function to split invoices from a PDF.
         
         Args:
-            pdf_path: Path to input PDF file
+            pdf_path: Path to input PDF file, or a readable binary file object
+                (e.g. a SpooledTemporaryFile or a read-only mmap) holding the PDF bytes
             attachment_id: ID of the attachment being processed
-            output_dir: Directory for output files (default: ./output)
+            output_dir: Directory for output files (default: ./output); unused
+                when use_memory_fs is set
+            filename: Name used for output files when pdf_path is a file object
+                (default: attachment_<attachment_id>.pdf)
+            unpublished: If given, receives the output files whose S3 upload or
+                invoice record failed (such failures do not fail the document)
             
         Returns:
-            List of output file paths
+            List of output file paths (with use_memory_fs, the S3 keys of the
+            uploaded invoice PDFs)
         """
-        pdf_path = Path(pdf_path)
-        if not pdf_path.exists():
-            raise FileNotFoundError(f"PDF file not found: {pdf_path}")
+        if isinstance(pdf_path, (str, Path)):
+            pdf_path = Path(pdf_path)
+            if not pdf_path.exists():
+                raise FileNotFoundError(f"PDF file not found: {pdf_path}")
+            pdf_name = pdf_path.name
+            pdf_source = str(pdf_path)
+        else:
+            pdf_name = filename or f"attachment_{attachment_id}.pdf"
+            pdf_source = pdf_path
+            pdf_source.seek(0)
         
         # Set output directory with attachment_id subdirectory
         if output_dir:
             output_dir = Path(output_dir) / str(attachment_id)
         else:
             output_dir = Path("output") / str(attachment_id)
-        output_dir.mkdir(parents=True, exist_ok=True)
-        
-        # Create errors directory
         errors_dir = output_dir / "errors"
-        errors_dir.mkdir(exist_ok=True)
+        if not self.use_memory_fs:
+            output_dir.mkdir(parents=True, exist_ok=True)
+            
+            # Create errors directory
+            errors_dir.mkdir(exist_ok=True)
         
-        self._log(f"Processing: {pdf_path.name}")
+        self._log(f"Processing: {pdf_name}")
         self._log(f"Output directory: {output_dir}")
         
+        # Status updates are sent in the background, in order, so the API round
+        # trip overlaps with PDF checks and rendering instead of blocking them
+        status_updates = ThreadPoolExecutor(max_workers=1)
+        
+        # One extraction call per invoice can start as soon as its page group is
+        # known, while later pages are still being analyzed
+        early_extractor = None
+        publisher = None
+        source_document = None
+        if self.extraction_batch_size == 1 and self.vision_concurrency > 1:
+            early_extractor = _EarlyExtractor(self.extract_invoice_data,
+                                              ThreadPoolExecutor(max_workers=self.vision_concurrency))
+        
         # Update status to processing
-        self.update_attachment_status(attachment_id, "processing")
+        status_updates.submit(self.update_attachment_status, attachment_id, "processing")
         
         try:
-            # Check for corruption
-            is_valid, error = self.check_pdf_corruption(str(pdf_path))
-            
-            if not is_valid:
-                self._log(f"⚠️  PDF appears corrupted: {error}", "warning")
+            # Convert PDF to images and analyze each page with Vision API; page
+            # analyses are independent network-bound calls, so keep several in
+            # flight and start them while later pages are still rendering.
+            # MuPDF recovers most damaged files as it opens them, so the pypdf
+            # repair only runs when rendering fails
+            self._log("Converting PDF pages to images...")
+            images = None
+            try:
+                images, analyses = self._render_and_analyze(
+                    pdf_source, on_page=early_extractor.add_page if early_extractor else None)
+            except Exception as e:
+                self._log(f"⚠️  PDF could not be rendered: {e}", level="warning")
                 self._log("Attempting to repair...")
                 
-                success, result = self.repair_pdf(str(pdf_path))
+                success, result = self.repair_pdf(pdf_source)
                 
                 if success:
-                    self._log(f"✓ PDF repaired successfully: {result}")
-                    pdf_path = Path(result)
+                    self._log(f"✓ PDF repaired successfully: {self._source_name(result)}")
+                    pdf_source = result
+                    # Groups seen before the failure may be incomplete; extract after analysis
+                    if early_extractor:
+                        early_extractor.pool.shutdown(cancel_futures=True)
+                        early_extractor = None
+                    try:
+                        images, analyses = self._render_and_analyze(pdf_source)
+                    except Exception as e:
+                        self._log(f"Error converting PDF to images: {e}", level="error")
                 else:
-                    self._log(f"✗ Repair failed: {result}", "error")
-                    error_file = errors_dir / pdf_path.name
-                    shutil.copy2(pdf_path, error_file)
-                    self._log(f"Copied to errors folder: {error_file}")
-                    self.update_attachment_status(attachment_id, "failed")
-                    return []
+                    self._log(f"✗ Repair failed: {result}", level="error")
             
-            # Convert PDF to images
-            self._log("Converting PDF pages to images...")
-            try:
-                images = convert_from_path(str(pdf_path), dpi=200)
-            except Exception as e:
-                self._log(f"Error converting PDF to images: {e}", "error")
-                error_file = errors_dir / pdf_path.name
-                shutil.copy2(pdf_path, error_file)
-                self._log(f"Copied to errors folder: {error_file}")
-                self.update_attachment_status(attachment_id, "failed")
+            if not images:
+                if images is not None:
+                    self._log("✗ PDF has no pages", level="error")
+                if not self.use_memory_fs:
+                    error_file = errors_dir / pdf_name
+                    self._copy_to_errors(pdf_source, error_file)
+                    self._log(f"Copied to errors folder: {error_file}")
+                status_updates.submit(self.update_attachment_status, attachment_id, "failed")
                 return []
             
             total_pages = len(images)
-            self._log(f"Total pages: {total_pages}")
             
-            # Analyze each page with Vision API
-            self._log("\nAnalyzing pages with GPT-4 Vision...")
-            analyses = []
-            for i, image in enumerate(images):
-                self._log(f"  Analyzing page {i + 1}/{total_pages}...")
-                analysis = self.analyze_page_with_vision(image, i + 1, total_pages)
-                analyses.append(analysis)
-                
+            extracted_invoices = None
+            if analyses is None:
+                # Short document: find its invoices and extract them in one request,
+                # falling back to separate boundary and extraction calls
+                self._log("\nAnalyzing and extracting pages with GPT-4 Vision...")
+                document = self.analyze_and_extract_document(images)
+                if document:
+                    analyses, invoice_groups, extracted_invoices = document
+                else:
+                    windows = self._map_vision(
+                        lambda first: self.analyze_document_boundaries(
+                            images[first:first + self.boundary_batch_size], first + 1, total_pages),
+                        list(range(0, total_pages, self.boundary_batch_size))
+                    )
+                    analyses = [analysis for window in windows for analysis in window]
+                    if early_extractor:
+                        for image, analysis in zip(images, analyses):
+                            early_extractor.add_page(image, analysis)
+            
+            for i, analysis in enumerate(analyses):
                 # Print analysis summary
                 status = "NEW INVOICE" if analysis.get("is_invoice_start") else "CONTINUATION"
                 inv_num = analysis.get("invoice_number") or "N/A"
-                self._log(f"{status} | Invoice#: {inv_num} | Confidence: {analysis.get('confidence', 0):.2f}")
+                self._log(f"  Page {i + 1}/{total_pages}: {status} | Invoice#: {inv_num} | Confidence: {analysis.get('confidence', 0):.2f}")
             
             # Group pages into invoices
             self._log("\nGrouping pages into invoices...")
-            invoice_groups = self.group_pages_into_invoices(analyses)
+            if extracted_invoices is None:
+                invoice_groups = self.group_pages_into_invoices(analyses)
             self._log(f"Found {len(invoice_groups)} invoice(s)")
             
+            # Extract invoice data for every group up front; the calls are independent
+            # of each other and of the merge/save steps below
+            if extracted_invoices is None:
+                self._log("\nExtracting invoice data...")
+                if early_extractor:
+                    early_extractor.finish()
+                    extracted_invoices = [early_extractor.futures[tuple(group)].result() for group in invoice_groups]
+                elif self.extraction_batch_size == 1:
+                    extracted_invoices = self._map_vision(
+                        lambda page_group: self.extract_invoice_data([images[i] for i in page_group]),
+                        invoice_groups
+                    )
+                else:
+                    batch_results = self._map_vision(
+                        lambda batch: self.extract_invoices_batch([[images[i] for i in group] for group in batch]),
+                        self._batch_invoice_groups(invoice_groups)
+                    )
+                    extracted_invoices = [invoice_data for batch in batch_results for invoice_data in batch]
+            
             # Extract and save each invoice with JSON data
             output_files = []
-            base_name = pdf_path.stem
+            base_name = Path(pdf_name).stem
             
-            # Track invoices created in THIS session only (for merging within same PDF)
-            session_invoices = {}  # invoice_number -> (pdf_path, json_path)
+            # Invoices of THIS session only, in order. A group whose invoice number was
+            # already seen is merged into the earlier invoice in memory, so every file
+            # is written (and uploaded) once, with its final contents
+            pending_invoices = []  # (pdf_path, json_path, page indices, invoice data)
+            session_invoices = {}  # invoice_number -> entry of pending_invoices
+            used_filenames = set()  # output file names of pending_invoices
             
             for idx, page_group in enumerate(invoice_groups, start=1):
-                # Try to get invoice number from the first page of the group
+                invoice_data = extracted_invoices[idx - 1]
+                
+                # Try to get invoice number from the first page of the group; a
+                # single-page document is not analyzed, so use its extracted number
                 invoice_num = analyses[page_group[0]].get("invoice_number")
+                if not invoice_num and len(analyses) == 1:
+                    invoice_num = invoice_data.get("invoice_number")
                 
                 if invoice_num:
                     # Sanitize invoice number for filename
-                    safe_invoice_num = "".join(c for c in invoice_num if c.isalnum() or c in "-_")
+                    safe_invoice_num = INVOICE_FILENAME_UNSAFE_CHARS.sub("", str(invoice_num))
                     output_filename = f"{base_name}_invoice_{safe_invoice_num}.pdf"
                 else:
                     output_filename = f"{base_name}_invoice_{idx}.pdf"
+                if output_filename in used_filenames:
+                    # Another invoice of this document already has the name; never
+                    # overwrite its files or S3 objects
+                    output_filename = output_filename.replace(".pdf", f"_{idx}.pdf")
                 
                 output_path = output_dir / output_filename
                 json_output_path = output_dir / output_filename.replace(".pdf", ".json")
                 
                 self._log(f"\n  Invoice {idx}: Pages {[p+1 for p in page_group]} -> {output_filename}")
                 
-                # Extract invoice data from the images for this invoice first
-                self._log(f"    Extracting invoice data...")
-                invoice_images = [images[i] for i in page_group]
-                invoice_data = self.extract_invoice_data(invoice_images)
-                
                 # Add attachment_id to invoice data
                 invoice_data["attachment_id"] = attachment_id
                 
                 # Check if this invoice number already exists IN THIS SESSION
                 extracted_invoice_num = invoice_data.get("invoice_number")
-                existing_files = None
+                existing_invoice = session_invoices.get(extracted_invoice_num) if extracted_invoice_num else None
                 
-                if extracted_invoice_num and extracted_invoice_num in session_invoices:
-                    existing_files = session_invoices[extracted_invoice_num]
-                
-                if existing_files:
-                    # Merge with existing invoice
-                    existing_json_path, existing_pdf_path = existing_files
+                if existing_invoice:
+                    # Merge with existing invoice: its pages and data grow in place
+                    existing_pdf_path, existing_json_path, existing_pages, merged_data = existing_invoice
                     self._log(f"    Found existing invoice with same number: {existing_json_path.name}")
                     
-                    try:
-                        # Read existing JSON data
-                        with open(existing_json_path, 'r', encoding='utf-8') as f:
-                            existing_data = json.load(f)
-                        
-                        # Merge the data
-                        merged_data = self.merge_invoice_data(existing_data, invoice_data)
-                        
-                        # Merge PDF files
-                        self._log(f"    Merging pages into existing PDF...")
-                        self.merge_pdf_files(str(existing_pdf_path), str(pdf_path), page_group)
-                        
-                        # Save merged JSON data
-                        with open(existing_json_path, 'w', encoding='utf-8') as json_file:
-                            json.dump(merged_data, json_file, indent=2, ensure_ascii=False)
-                        
-                        self._log(f"    Updated JSON: {existing_json_path.name}")
-                        self._log(f"    Merged invoice data (total line items: {len(merged_data.get('line_items', []))})")
-                        
-                        # Upload updated files to S3
-                        try:
-                            pdf_s3_key = f"invoices/{attachment_id}/{existing_pdf_path.name}"
-                            json_s3_key = f"invoices/{attachment_id}/{existing_json_path.name}"
-                            
-                            self.upload_to_s3(str(existing_pdf_path), pdf_s3_key, mime_type="application/pdf")
-                            self.upload_to_s3(str(existing_json_path), json_s3_key, mime_type="application/json")
-
-                            tmp = {
-                                "merged_data": merged_data,
-                                "attachment_id": attachment_id,
-                                "pdf_s3_key": pdf_s3_key,
-                                "json_s3_key": json_s3_key,
-                            }
-                            self._log(f"{tmp}", "debug")
-                            
-                            # Create/update invoice record in database
-                            self.create_invoice_record(merged_data, attachment_id, pdf_s3_key, json_s3_key)
-                        except Exception as e:
-                            self._log(f"    Warning: S3 upload or API call failed: {e}", "warning")
-                        
-                        # Add existing file to output (if not already there)
-                        if str(existing_pdf_path) not in output_files:
-                            output_files.append(str(existing_pdf_path))
-                        
-                    except Exception as e:
-                        self._log(f"    Error merging invoice: {e}", "error")
-                        self._log(f"    Creating separate file instead...")
-                        # Fall back to creating new files
-                        self.extract_pages_to_pdf(str(pdf_path), page_group, str(output_path))
-                        output_files.append(str(output_path))
-                        with open(json_output_path, 'w', encoding='utf-8') as json_file:
-                            json.dump(invoice_data, json_file, indent=2, ensure_ascii=False)
-                        self._log(f"    Saved JSON: {json_output_path.name}")
-                        
-                        # Upload to S3 and create invoice record for fallback case
-                        try:
-                            pdf_s3_key = f"invoices/{attachment_id}/{output_filename}"
-                            json_s3_key = f"invoices/{attachment_id}/{json_output_path.name}"
-                            
-                            self.upload_to_s3(str(output_path), pdf_s3_key, mime_type="application/pdf")
-                            self.upload_to_s3(str(json_output_path), json_s3_key, mime_type="application/json")
-                            
-                            # Create invoice record in database
-                            self.create_invoice_record(invoice_data, attachment_id, pdf_s3_key, json_s3_key)
-                        except Exception as upload_error:
-                            self._log(f"    Warning: S3 upload or API call failed: {upload_error}", "warning")
-                else:
-                    # Create new invoice files
-                    self.extract_pages_to_pdf(str(pdf_path), page_group, str(output_path))
-                    output_files.append(str(output_path))
-                    
-                    # Save JSON data
-                    with open(json_output_path, 'w', encoding='utf-8') as json_file:
-                        json.dump(invoice_data, json_file, indent=2, ensure_ascii=False)
+                    self.merge_invoice_data(merged_data, invoice_data, in_place=True)
+                    existing_pages.extend(page_group)
                     
-                    self._log(f"    Saved PDF: {output_filename}")
-                    self._log(f"    Saved JSON: {json_output_path.name}")
+                    self._log(f"    Merged {len(page_group)} page(s) into {existing_pdf_path.name}")
+                    self._log(f"    Merged invoice data (total line items: {len(merged_data.get('line_items') or [])})")
                     
-                    # Upload to S3 and create invoice record
-                    try:
-                        pdf_s3_key = f"invoices/{attachment_id}/{output_filename}"
-                        json_s3_key = f"invoices/{attachment_id}/{json_output_path.name}"
-                        
-                        self.upload_to_s3(str(output_path), pdf_s3_key, mime_type="application/pdf")
-                        self.upload_to_s3(str(json_output_path), json_s3_key, mime_type="application/json")
-                        
-                        # Create invoice record in database
-                        self.create_invoice_record(invoice_data, attachment_id, pdf_s3_key, json_s3_key)
-                    except Exception as e:
-                        self._log(f"    Warning: S3 upload or API call failed: {e}", "warning")
+                    self._log("    DEBUG: Merged upload: attachment=%s pdf=%s json=%s items=%d",
+                              attachment_id, existing_pdf_path.name, existing_json_path.name,
+                              len(merged_data.get("line_items") or []), level="debug")
+                else:
+                    pending_invoice = (output_path, json_output_path, list(page_group), invoice_data)
+                    pending_invoices.append(pending_invoice)
+                    used_filenames.add(output_filename)
                     
                     # Register this invoice in the session for potential future merges
                     if extracted_invoice_num:
-                        session_invoices[extracted_invoice_num] = (json_output_path, output_path)
+                        session_invoices[extracted_invoice_num] = pending_invoice
                 
                 # Display extracted info summary
                 if invoice_data.get("invoice_number"):
@@ -850,15 +1870,101 @@ Respond ONLY with valid JSON in this exact format:
                 if invoice_data.get("line_items"):
                     self._log(f"    Line items: {len(invoice_data['line_items'])}")
             
+            # One MuPDF document for all of the source's invoices
+            source_document = self._open_document(pdf_source)
+            
+            # Files are written here in order, while uploads and record creation
+            # run in the background
+            self._log("\nSaving invoices...")
+            publisher = ThreadPoolExecutor(max_workers=max(1, min(PUBLISH_MAX_WORKERS, len(pending_invoices))))
+            published = []  # (output file, future of publish_invoice's result)
+            
+            for output_path, json_output_path, page_indices, invoice_data in pending_invoices:
+                # The same JSON bytes are saved and uploaded, without reading the file back
+                json_payload = orjson.dumps(invoice_data, option=self.invoice_json_option)
+                
+                if self.use_memory_fs:
+                    pdf_buffer = BytesIO()
+                    self.extract_pages_to_pdf(pdf_source, page_indices, pdf_buffer, document=source_document)
+                    output_files.append(f"invoices/{attachment_id}/{output_path.name}")
+                    
+                    # Upload to S3 and create invoice record
+                    published.append((output_files[-1], publisher.submit(
+                        self.publish_invoice, invoice_data, attachment_id, output_path, json_output_path,
+                        json_payload, pdf_buffer.getvalue())))
+                    continue
+                
+                self.extract_pages_to_pdf(pdf_source, page_indices, str(output_path), document=source_document)
+                output_files.append(str(output_path))
+                
+                # Save JSON data
+                with atomic_output_path(json_output_path) as tmp_path:
+                    with open(tmp_path, 'wb') as json_file:
+                        json_file.write(json_payload)
+                
+                self._log(f"    Saved PDF: {output_path.name}")
+                self._log(f"    Saved JSON: {json_output_path.name}")
+                
+                # Upload to S3 and create invoice record
+                published.append((output_files[-1], publisher.submit(
+                    self.publish_invoice, invoice_data, attachment_id, output_path, json_output_path,
+                    json_payload)))
+            
+            # Every invoice must be uploaded and recorded before reporting success
+            publisher.shutdown(wait=True)
+            failed_files = [output_file for output_file, future in published if not future.result()]
+            if failed_files:
+                self._log(f"⚠️  {len(failed_files)} invoice(s) were not uploaded or recorded", level="warning")
+                if unpublished is not None:
+                    unpublished.extend(failed_files)
+            
             self._log(f"\n✓ Successfully split into {len(output_files)} invoice(s)")
             self._log(f"✓ Generated {len(output_files)} JSON data files")
             
             # Update status to success
-            self.update_attachment_status(attachment_id, "success")
+            status_updates.submit(self.update_attachment_status, attachment_id, "success")
             
             return output_files
             
         except Exception as e:
-            self._log(f"Unexpected error during processing: {str(e)}", "error")
-            self.update_attachment_status(attachment_id, "failed")
+            self._log(f"Unexpected error during processing: {str(e)}", level="error")
+            status_updates.submit(self.update_attachment_status, attachment_id, "failed")
             raise
+        finally:
+            if early_extractor:
+                early_extractor.pool.shutdown(cancel_futures=True)
+            if publisher:
+                publisher.shutdown(wait=True)
+            if source_document is not None:
+                self._close_document(source_document)
+            # The final status must reach the API before the caller moves on
+            status_updates.shutdown(wait=True)
+    
+    @classmethod
+    def process_batch(cls, items: List[Tuple[Union[str, Path], int]], output_dir: Optional[str] = None,
+                      workers: Optional[int] = None, **splitter_kwargs) -> List[List[str]]:
+        """
+        Split several local PDFs in parallel, one worker process per PDF at a time.
+        
+        Each worker builds its own splitter (and API/S3 clients) once and reuses it
+        for every PDF it is handed, so the rendering and PDF writing of different
+        attachments run on separate cores instead of taking turns on the MuPDF lock.
+        
+        Args:
+            items: (pdf_path, attachment_id) pairs
+            output_dir: Directory for output files (default: ./output)
+            workers: Number of worker processes (default: CPU count, at most BATCH_MAX_WORKERS)
+            **splitter_kwargs: Arguments for each worker's splitter (e.g. vision_concurrency);
+                workers log with print unless a picklable logger is passed
+            
+        Returns:
+            Output file paths of each item, in the order of items
+        """
+        if not items:
+            return []
+        workers = workers or min(os.cpu_count() or 1, BATCH_MAX_WORKERS)
+        with ProcessPoolExecutor(max_workers=min(workers, len(items)), mp_context=_process_pool_context(),
+                                 initializer=_init_batch_worker, initargs=(cls, splitter_kwargs)) as pool:
+            futures = [pool.submit(_process_pdf_in_worker, str(pdf_path), attachment_id, output_dir)
+                       for pdf_path, attachment_id in items]
+            return [future.result() for future in futures]
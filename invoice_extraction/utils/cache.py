@@ -0,0 +1,127 @@
+"""
+On-disk cache for invoice extraction service.
+
+Stores attachment metadata and downloaded PDFs so repeated runs against the
+same attachment skip the attachment API and S3.
+"""
+
+import os
+import time
+import shutil
+import hashlib
+import tempfile
+from pathlib import Path
+from typing import Any, BinaryIO, Optional
+from urllib.parse import urlparse, urlunparse
+
+import orjson
+
+from invoice_extraction import __version__
+
+DEFAULT_CACHE_DIR = "~/.cache/invoice-extractor"
+
+
+def url_cache_key(file_url: str) -> str:
+    """
+    Build a stable cache key for a file URL.
+    
+    The query string is dropped so presigned URLs for the same object
+    (which differ only in their signature and expiry) share one entry.
+    """
+    parsed = urlparse(file_url)
+    unsigned_url = urlunparse(parsed._replace(query="", fragment=""))
+    return hashlib.sha256(unsigned_url.encode("utf-8")).hexdigest()
+
+
+class DiskCache:
+    """File-based cache with JSON entries and binary blobs, grouped by namespace."""
+    
+    def __init__(self, cache_dir: Optional[str] = None):
+        """
+        Initialize the cache.
+        
+        Args:
+            cache_dir: Root cache directory (if None, reads INVOICE_CACHE_DIR env var,
+                falling back to ~/.cache/invoice-extractor)
+        """
+        cache_dir = cache_dir or os.getenv("INVOICE_CACHE_DIR", DEFAULT_CACHE_DIR)
+        self.cache_dir = Path(cache_dir).expanduser()
+    
+    def _namespace_dir(self, namespace: str) -> Path:
+        """Return (and create) the directory for a namespace."""
+        path = self.cache_dir / namespace
+        path.mkdir(parents=True, exist_ok=True)
+        return path
+    
+    def _write_atomic(self, path: Path, data: bytes):
+        """Write data to path via a temp file and rename so readers never see partial files."""
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            Path(tmp_path).unlink(missing_ok=True)
+            raise
+    
+    def get_json(self, namespace: str, key: str, max_age: Optional[float] = None) -> Optional[Any]:
+        """
+        Read a JSON entry.
+        
+        Args:
+            namespace: Cache namespace (e.g. "meta")
+            key: Entry key
+            max_age: Maximum entry age in seconds (None for no expiry)
+        
+        Returns:
+            Cached value, or None if missing, expired or unreadable
+        """
+        path = self._namespace_dir(namespace) / f"{key}.json"
+        try:
+            with open(path, "rb") as f:
+                entry = orjson.loads(f.read())
+        except (OSError, orjson.JSONDecodeError):
+            return None
+        
+        if max_age is not None and time.time() - entry.get("created_at", 0) > max_age:
+            return None
+        return entry.get("value")
+    
+    def set_json(self, namespace: str, key: str, value: Any):
+        """Store a JSON entry along with its creation time and package version."""
+        entry = {"created_at": time.time(), "version": __version__, "value": value}
+        path = self._namespace_dir(namespace) / f"{key}.json"
+        self._write_atomic(path, orjson.dumps(entry))
+    
+    def blob_path(self, namespace: str, key: str, suffix: str = "") -> Path:
+        """Return the path a blob is (or would be) stored at."""
+        return self._namespace_dir(namespace) / f"{key}{suffix}"
+    
+    def store_blob(self, namespace: str, key: str, fileobj: BinaryIO, suffix: str = "",
+                   metadata: Optional[dict] = None) -> Path:
+        """
+        Copy a readable binary file object into the cache.
+        
+        Args:
+            namespace: Cache namespace (e.g. "pdfs")
+            key: Entry key
+            fileobj: Source file object (read from its start, left at its end)
+            suffix: File suffix for the stored blob (e.g. ".pdf")
+            metadata: Extra details saved in a JSON sidecar next to the blob
+        
+        Returns:
+            Path of the stored blob
+        """
+        path = self.blob_path(namespace, key, suffix)
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=".tmp-")
+        try:
+            fileobj.seek(0)
+            with os.fdopen(fd, "wb") as f:
+                shutil.copyfileobj(fileobj, f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            Path(tmp_path).unlink(missing_ok=True)
+            raise
+        
+        self.set_json(namespace, key, metadata or {})
+        return path
@@ -3,27 +3,50 @@ Logging configuration for invoice extraction service.
 """
 
 import os
+import queue
+import atexit
 import logging
 import logging.handlers
 from pathlib import Path
-from typing import Optional
+from typing import Dict, List, Optional
 
+# Background listeners writing queued records, keyed by service name
+_listeners: Dict[str, logging.handlers.QueueListener] = {}
 
-def setup_logger(service_name: str, enable_file_logging: Optional[bool] = None) -> logging.Logger:
+
+def _stop_listeners():
+    """Flush and stop all background log listeners (registered with atexit)."""
+    for listener in _listeners.values():
+        listener.stop()
+    _listeners.clear()
+
+
+atexit.register(_stop_listeners)
+
+
+def setup_logger(service_name: str, enable_file_logging: Optional[bool] = None,
+                 asynchronous: bool = True) -> logging.Logger:
     """
     Set up logger with conditional file logging based on DEBUG_LOG environment variable.
     
     Args:
         service_name: Name of the service for log file naming
         enable_file_logging: Force enable/disable file logging. If None, reads from DEBUG_LOG env var.
+        asynchronous: Hand records to a background thread through a queue so logging
+            calls never block on file/console I/O. Disable where the process may be
+            frozen right after returning (e.g. AWS Lambda) and logs must be written inline.
         
     Returns:
         Configured logger instance
     """
     logger = logging.getLogger(service_name)
     
-    # Clear any existing handlers
+    # Flush the listener of a previous setup, then clear any existing handlers
+    previous_listener = _listeners.pop(service_name, None)
+    if previous_listener:
+        previous_listener.stop()
     logger.handlers.clear()
+    handlers: List[logging.Handler] = []
     
     # Determine if file logging should be enabled
     if enable_file_logging is None:
@@ -50,7 +73,7 @@ def setup_logger(service_name: str, enable_file_logging: Optional[bool] = None)
             datefmt="%Y-%m-%d %H:%M:%S"
         )
         file_handler.setFormatter(file_formatter)
-        logger.addHandler(file_handler)
+        handlers.append(file_handler)
         
         print(f"File logging enabled: {log_file}")
     else:
@@ -65,7 +88,18 @@ def setup_logger(service_name: str, enable_file_logging: Optional[bool] = None)
     )
     console_handler.setFormatter(console_formatter)
     console_handler.setLevel(log_level)
-    logger.addHandler(console_handler)
+    handlers.append(console_handler)
+    
+    if asynchronous:
+        # Logging calls only enqueue; one listener thread does the actual writes
+        log_queue = queue.Queue(-1)
+        logger.addHandler(logging.handlers.QueueHandler(log_queue))
+        listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+        listener.start()
+        _listeners[service_name] = listener
+    else:
+        for handler in handlers:
+            logger.addHandler(handler)
     
     # Set logger level
     logger.setLevel(log_level)
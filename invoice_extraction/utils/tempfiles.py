@@ -0,0 +1,71 @@
+"""
+Temporary file helpers for invoice extraction service.
+"""
+
+import os
+import tempfile
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator, Optional, Union
+
+# PDFs up to this size stay in memory; larger downloads spill to a temp file
+SPOOL_MAX_SIZE = 64 * 1024 * 1024
+
+# Process umask, read once at import (reading it means setting it, which is not
+# thread-safe) so atomically written files get the usual default permissions
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+def get_temp_dir() -> Optional[str]:
+    """
+    Get the directory for temporary PDF files.
+    
+    Prefers the INVOICE_TMPDIR environment variable, then /dev/shm (tmpfs) when
+    available so PDF bytes stay in RAM instead of hitting disk.
+    
+    Returns:
+        Directory path, or None to use the system default temp directory
+    """
+    tmp_dir = os.getenv("INVOICE_TMPDIR")
+    if tmp_dir:
+        return tmp_dir
+    if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+        return "/dev/shm"
+    return None
+
+
+def spooled_pdf_file() -> tempfile.SpooledTemporaryFile:
+    """
+    Create a binary buffer for a downloaded PDF.
+    
+    The buffer stays in memory up to SPOOL_MAX_SIZE and only then spills to a
+    temp file in get_temp_dir(), so typical PDFs never touch disk.
+    """
+    return tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE, suffix=".pdf", dir=get_temp_dir())
+
+
+@contextmanager
+def atomic_output_path(path: Union[str, Path]) -> Iterator[str]:
+    """
+    Yield a temp file path next to path, renamed over path on success.
+    
+    The temp file lives in the same directory, so the final os.replace is
+    atomic: a crash or failed write leaves the previous file (or none) rather
+    than a truncated one. The result keeps the mode of the file it replaces,
+    or gets the umask default for new files (mkstemp creates them 0600).
+    """
+    path = Path(path)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=".tmp-", suffix=path.suffix)
+    os.close(fd)
+    try:
+        yield tmp_path
+        try:
+            mode = path.stat().st_mode & 0o7777
+        except FileNotFoundError:
+            mode = 0o666 & ~_UMASK
+        os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    except BaseException:
+        Path(tmp_path).unlink(missing_ok=True)
+        raise
@@ -4,19 +4,86 @@ AWS Lambda handler for invoice extraction service.
 This module handles SQS events and processes PDF invoices in a serverless environment.
 """
 
-import json
-import tempfile
 import os
+import tempfile
 from typing import Dict, List, Any
 
+import boto3
+import orjson
+
 from invoice_extraction.core.processor import InvoiceSplitter
 from invoice_extraction.utils.logger import setup_logger
+from invoice_extraction.utils.tempfiles import spooled_pdf_file
+
+# Processor reused by every record and warm invocation of this container, so its
+# OpenAI/S3/HTTP clients and their connections are set up only once
+_PROCESSOR = None
+
+
+def _get_processor(logger) -> InvoiceSplitter:
+    """Return the container's processor, creating it on first use."""
+    global _PROCESSOR
+    if _PROCESSOR is None:
+        # Split invoices are built and uploaded in memory, so nothing
+        # accumulates in /tmp across warm invocations
+        _PROCESSOR = InvoiceSplitter(logger=logger, use_memory_fs=True)
+    return _PROCESSOR
+
+
+_LAMBDA_CLIENT = None
+
+
+def _dispatch_records(records: List[Dict[str, Any]], function_name: str, logger) -> Dict[str, Any]:
+    """
+    Hand each SQS record to its own asynchronous invocation of the worker function.
+    
+    Args:
+        records: SQS records of the incoming event
+        function_name: Name or ARN of the worker Lambda function
+        logger: Logger instance
+        
+    Returns:
+        Dict with the same shape as handler's result, counting dispatched records,
+        plus batchItemFailures naming the records that could not be dispatched so
+        SQS redelivers them (requires ReportBatchItemFailures on the event source)
+    """
+    global _LAMBDA_CLIENT
+    if _LAMBDA_CLIENT is None:
+        _LAMBDA_CLIENT = boto3.client('lambda')
+    
+    dispatched = []
+    failed = []
+    for record in records:
+        try:
+            _LAMBDA_CLIENT.invoke(
+                FunctionName=function_name,
+                InvocationType='Event',
+                Payload=orjson.dumps({'Records': [record]})
+            )
+            dispatched.append({'message_id': record.get('messageId')})
+        except Exception as e:
+            logger.error(f"Failed to dispatch record {record.get('messageId')}: {str(e)}", exc_info=True)
+            failed.append({'message_id': record.get('messageId'), 'error': str(e)})
+    
+    logger.info(f"Dispatched {len(dispatched)} of {len(records)} records to {function_name}")
+    return {
+        'statusCode': 200,
+        'processed_count': len(dispatched),
+        'failed_count': len(failed),
+        'processed_attachments': dispatched,
+        'failed_attachments': failed,
+        'batchItemFailures': [{'itemIdentifier': item['message_id']} for item in failed]
+    }
 
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     """
     AWS Lambda handler for processing SQS messages containing attachment IDs.
     
+    With LAMBDA_ROLE=dispatcher (and WORKER_FUNCTION_NAME set), records are not
+    processed here but each handed to an asynchronous invocation of the worker
+    function, which runs this handler with the default LAMBDA_ROLE=worker.
+    
     Args:
         event: SQS event containing records with attachment IDs
         context: Lambda context object
@@ -25,13 +92,19 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         Dict containing processing results and status
     """
     print("Function started")
-    # Set up logger (file logging disabled for Lambda)
-    logger = setup_logger("invoice-extraction", enable_file_logging=False)
+    # Set up logger (file logging disabled for Lambda; write inline so nothing is
+    # left queued when the sandbox freezes after the handler returns)
+    logger = setup_logger("invoice-extraction", enable_file_logging=False, asynchronous=False)
     
     logger.info(f"Received event with {len(event.get('Records', []))} records")
 
     print("Event received")
     print(event)
+    
+    worker_function = os.getenv('WORKER_FUNCTION_NAME')
+    if os.getenv('LAMBDA_ROLE', 'worker') == 'dispatcher' and worker_function:
+        return _dispatch_records(event.get('Records', []), worker_function, logger)
+    
     processed_attachments = []
     failed_attachments = []
     
@@ -42,7 +115,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 # Parse the message body
                 message_body = None
                 if type(record.get('body',{})) == str:
-                    message_body = json.loads(record['body'])
+                    message_body = orjson.loads(record['body'])
                 else:
                     message_body = record.get('body',{})
 
@@ -66,8 +139,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 
                 logger.info(f"Processing attachment ID: {attachment_id}")
                 
-                # Initialize processor
-                processor = InvoiceSplitter(logger=logger)
+                processor = _get_processor(logger)
                 
                 # Fetch attachment metadata
                 attachment_data = processor.fetch_attachment_metadata(attachment_id)
@@ -79,19 +151,13 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 
                 logger.info(f"Processing: {filename}")
                 
-                # Download PDF to Lambda's /tmp directory
-                temp_pdf_path = os.path.join('/tmp', f"attachment_{attachment_id}.pdf")
-                processor.download_pdf_from_url(file_url, temp_pdf_path)
-                
-                # Process the PDF (output to /tmp as well)
-                output_files = processor.process_pdf(temp_pdf_path, attachment_id, '/tmp/output')
-                
-                # Clean up temp files
-                try:
-                    os.remove(temp_pdf_path)
-                    logger.info(f"Cleaned up temporary file: {temp_pdf_path}")
-                except Exception as e:
-                    logger.warning(f"Warning: Failed to clean up temporary file: {e}")
+                # Download PDF into memory (closing the buffer frees it, so nothing
+                # is left behind in /tmp across warm invocations)
+                with spooled_pdf_file() as pdf_file:
+                    processor.download_pdf_from_url(file_url, pdf_file)
+                    
+                    # Process the PDF
+                    output_files = processor.process_pdf(pdf_file, attachment_id, '/tmp/output')
                 
                 if output_files:
                     processed_attachments.append({
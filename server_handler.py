@@ -5,22 +5,35 @@ This module implements a long-polling SQS worker that runs continuously on EC2 i
 """
 
 import os
-import json
 import signal
 import sys
-import tempfile
 import time
-from typing import Dict, Any
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Dict, Any, List
 from dotenv import load_dotenv
 
 import boto3
+import orjson
 from botocore.exceptions import ClientError
 
 from invoice_extraction.core.processor import InvoiceSplitter
 from invoice_extraction.utils.logger import setup_logger
+from invoice_extraction.utils.tempfiles import spooled_pdf_file
 
 load_dotenv()
 
+# SQS returns at most this many messages per receive call
+SQS_MAX_MESSAGES = 10
+
+# Long-poll wait while idle, and the shorter wait used while messages are in
+# flight so finished ones are deleted promptly
+SQS_IDLE_WAIT_SECONDS = 20
+SQS_BUSY_WAIT_SECONDS = 2
+
+# Processed messages are deleted in batches: once SQS_MAX_MESSAGES are waiting,
+# when the worker goes idle, or when the oldest has waited this long
+SQS_DELETE_MAX_DELAY_SECONDS = 5
+
 
 class SQSWorker:
     """Long-polling SQS worker for invoice extraction."""
@@ -35,6 +48,15 @@ class SQSWorker:
         if not self.queue_url:
             raise ValueError("SQS_QUEUE_URL environment variable not found")
         
+        # Messages processed at once; each runs in its own thread, as PDF
+        # processing is mostly waiting on the network
+        self.concurrency = max(1, int(os.getenv('WORKER_CONCURRENCY', '8')))
+        self.executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        
+        # One processor for the worker's lifetime, so its HTTP session keeps
+        # connections to the attachment API alive between messages
+        self.processor = InvoiceSplitter(logger=self.logger)
+        
         self.logger.info(f"Initialized SQS worker for queue: {self.queue_url}")
         
         # Set up signal handlers for graceful shutdown
@@ -61,7 +83,7 @@ class SQSWorker:
         
         try:
             # Parse message body
-            message_body = json.loads(message['Body'])
+            message_body = orjson.loads(message['Body'])
             attachment_id = message_body.get('attachment_id')
             
             if not attachment_id:
@@ -70,8 +92,7 @@ class SQSWorker:
             
             self.logger.info(f"Processing attachment ID: {attachment_id}")
             
-            # Initialize processor
-            processor = InvoiceSplitter(logger=self.logger)
+            processor = self.processor
             
             # Fetch attachment metadata
             attachment_data = processor.fetch_attachment_metadata(attachment_id)
@@ -83,13 +104,12 @@ class SQSWorker:
             
             self.logger.info(f"Processing: {filename}")
             
-            # Download PDF to temporary location
-            temp_pdf_path = tempfile.mktemp(suffix=".pdf", prefix=f"attachment_{attachment_id}_")
-            processor.download_pdf_from_url(file_url, temp_pdf_path)
-            
-            try:
+            # Download PDF into memory (spills to tmpfs only for very large files)
+            with spooled_pdf_file() as pdf_file:
+                processor.download_pdf_from_url(file_url, pdf_file)
+                
                 # Process the PDF
-                output_files = processor.process_pdf(temp_pdf_path, attachment_id)
+                output_files = processor.process_pdf(pdf_file, attachment_id)
                 
                 if output_files:
                     self.logger.info(f"✓ Successfully processed attachment {attachment_id}")
@@ -99,68 +119,121 @@ class SQSWorker:
                     self.logger.error(f"✗ No invoices extracted for attachment {attachment_id}")
                     return False
                     
-            finally:
-                # Clean up temporary file
-                try:
-                    os.remove(temp_pdf_path)
-                    self.logger.debug(f"Cleaned up temporary file: {temp_pdf_path}")
-                except Exception as e:
-                    self.logger.warning(f"Warning: Failed to clean up temporary file: {e}")
-                    
         except Exception as e:
             self.logger.error(f"Error processing message {message_id}: {str(e)}", exc_info=True)
             return False
     
-    def delete_message(self, message: Dict[str, Any]):
-        """Delete a processed message from the SQS queue."""
+    def delete_messages(self, messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Delete processed messages from the SQS queue, up to 10 per request.
+        
+        Entries the batch call reports as failed are retried one at a time.
+        
+        Returns:
+            The messages that were actually deleted
+        """
+        deleted = []
+        for start in range(0, len(messages), SQS_MAX_MESSAGES):
+            chunk = messages[start:start + SQS_MAX_MESSAGES]
+            try:
+                response = self.sqs_client.delete_message_batch(
+                    QueueUrl=self.queue_url,
+                    Entries=[
+                        {'Id': str(i), 'ReceiptHandle': message['ReceiptHandle']}
+                        for i, message in enumerate(chunk)
+                    ]
+                )
+            except ClientError as e:
+                self.logger.error(f"Failed to delete message batch: {e}")
+                continue
+            
+            failed_ids = set()
+            for failure in response.get('Failed', []):
+                failed_ids.add(failure['Id'])
+                message = chunk[int(failure['Id'])]
+                self.logger.warning(f"Batch delete failed for message {message.get('MessageId')}: "
+                                    f"{failure.get('Code')} {failure.get('Message', '')}")
+                if self.delete_message(message):
+                    deleted.append(message)
+            deleted.extend(message for i, message in enumerate(chunk) if str(i) not in failed_ids)
+            self.logger.debug(f"Deleted {len(chunk) - len(failed_ids)} message(s) in one batch")
+        return deleted
+    
+    def delete_message(self, message: Dict[str, Any]) -> bool:
+        """Delete a processed message from the SQS queue; returns whether it was deleted."""
         try:
             self.sqs_client.delete_message(
                 QueueUrl=self.queue_url,
                 ReceiptHandle=message['ReceiptHandle']
             )
             self.logger.debug(f"Deleted message {message.get('MessageId')}")
+            return True
         except ClientError as e:
             self.logger.error(f"Failed to delete message: {e}")
+            return False
     
     def run(self):
-        """Main worker loop with long-polling."""
-        self.logger.info("Starting SQS worker...")
+        """
+        Main worker loop with long-polling.
+        
+        Up to `concurrency` messages are processed at a time, and new messages
+        are received whenever a slot is free. Successful messages are deleted
+        without waiting for the rest of their receive batch, several per
+        delete request (see SQS_DELETE_MAX_DELAY_SECONDS).
+        """
+        self.logger.info(f"Starting SQS worker ({self.concurrency} concurrent messages)...")
         self.running = True
+        in_flight: Dict[Future, Dict[str, Any]] = {}
+        pending_deletes: List[Dict[str, Any]] = []
+        pending_since = 0.0
         
-        while self.running:
+        while self.running or in_flight:
             try:
-                # Long-poll for messages (20 second wait time)
-                response = self.sqs_client.receive_message(
-                    QueueUrl=self.queue_url,
-                    MaxNumberOfMessages=1,
-                    WaitTimeSeconds=20,
-                    AttributeNames=['All'],
-                    MessageAttributeNames=['All']
-                )
-                
-                messages = response.get('Messages', [])
-                
-                if not messages:
-                    # No messages received, continue polling
-                    continue
-                
-                for message in messages:
-                    if not self.running:
-                        break
-                    
-                    message_id = message.get('MessageId')
-                    self.logger.info(f"Received message: {message_id}")
+                free_slots = self.concurrency - len(in_flight)
+                if self.running and free_slots > 0:
+                    response = self.sqs_client.receive_message(
+                        QueueUrl=self.queue_url,
+                        MaxNumberOfMessages=min(SQS_MAX_MESSAGES, free_slots),
+                        WaitTimeSeconds=SQS_BUSY_WAIT_SECONDS if in_flight else SQS_IDLE_WAIT_SECONDS,
+                        AttributeNames=['All'],
+                        MessageAttributeNames=['All']
+                    )
                     
-                    # Process the message
-                    success = self.process_message(message)
+                    for message in response.get('Messages', []):
+                        self.logger.info(f"Received message: {message.get('MessageId')}")
+                        in_flight[self.executor.submit(self.process_message, message)] = message
+                
+                if in_flight:
+                    # Block only when every slot is busy (or when draining on
+                    # shutdown), and no longer than pending deletes may wait
+                    timeout = 0
+                    if len(in_flight) >= self.concurrency or not self.running:
+                        timeout = None
+                        if pending_deletes:
+                            timeout = max(0, pending_since + SQS_DELETE_MAX_DELAY_SECONDS - time.monotonic())
+                    done, _ = wait(in_flight, timeout=timeout, return_when=FIRST_COMPLETED)
                     
-                    if success:
-                        # Delete the message from the queue
-                        self.delete_message(message)
-                        self.logger.info(f"Successfully processed and deleted message: {message_id}")
-                    else:
-                        # Leave message in queue for retry (DLQ will handle failures)
-                        self.logger.warning(f"Failed to process message: {message_id}")
+                    for future in done:
+                        message = in_flight.pop(future)
+                        if future.result():
+                            if not pending_deletes:
+                                pending_since = time.monotonic()
+                            pending_deletes.append(message)
+                        else:
+                            # Leave message in queue for retry (DLQ will handle failures)
+                            self.logger.warning(f"Failed to process message: {message.get('MessageId')}")
+                
+                if pending_deletes and (len(pending_deletes) >= SQS_MAX_MESSAGES or not in_flight
+                                        or time.monotonic() - pending_since >= SQS_DELETE_MAX_DELAY_SECONDS):
+                    messages, pending_deletes = pending_deletes, []
+                    deleted = self.delete_messages(messages)
+                    deleted_handles = {message['ReceiptHandle'] for message in deleted}
+                    for message in messages:
+                        if message['ReceiptHandle'] in deleted_handles:
+                            self.logger.info(f"Successfully processed and deleted message: {message.get('MessageId')}")
+                        else:
+                            # Still in the queue, so it will be redelivered after its visibility timeout
+                            self.logger.error(f"Processed message {message.get('MessageId')} but could not delete it")
                 
             except ClientError as e:
                 self.logger.error(f"SQS client error: {e}")
@@ -169,6 +242,8 @@ class SQSWorker:
                 self.logger.error(f"Unexpected error in worker loop: {e}", exc_info=True)
                 time.sleep(5)  # Wait before retrying
         
+        self.executor.shutdown(wait=True)
+        self.processor.close()
         self.logger.info("SQS worker stopped")
 
 